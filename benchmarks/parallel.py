@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""Compare single-threaded, thread-based and process-based execution of the
+tree-based ``vrt`` commands.
+
+A synthetic vertical is generated (unless one is given with ``--input``) and
+each command is run on it:
+
+- single: ``vrt COMMAND``, parsing one structure at a time
+- threads: ``vrt --threads N COMMAND``, parsing up to 2 * N structures at
+  once in a pool of threads
+- processes: each structure is pickled and sent to a pool of N processes,
+  which run ``COMMAND`` on it and send the output back
+
+Times are medians of ``--repeat`` runs. The structure numbering of
+``identify`` and the fallback ids of ``chunk`` restart with every structure
+in the process-based runs, which doesn't matter for timing.
+
+    python benchmarks/parallel.py --jobs 4
+
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import functools
+import statistics
+import multiprocessing
+
+import pyvert
+from pyvert import vrt
+
+# the commands process the vertical document by document
+COMMANDS = {
+    "chunk": dict(ancestor="doc", child="s", minmax=(200, 500)),
+    "group": dict(target="s", attr=["n"], parent="doc"),
+    "project": dict(parent="doc", child="s"),
+    "identify": dict(struct="doc"),
+}
+ARGS = {
+    "chunk": ["-a", "doc", "-c", "s", "-m", "200", "500"],
+    "group": ["-t", "s", "-a", "n", "-p", "doc"],
+    "project": ["-p", "doc", "-c", "s"],
+    "identify": ["-s", "doc"],
+}
+
+
+def generate(path, docs, sents, seed=0):
+    """Write a vertical of ``docs`` documents of ``sents`` sentences each,
+    in paragraphs of 10 sentences, to ``path``.
+
+    """
+    rng = random.Random(seed)
+    words = ["word{}".format(i) for i in range(5000)]
+    with open(path, "w", encoding="utf-8") as fh:
+        for d in range(docs):
+            fh.write('<doc id="d{}" author="a{}" year="{}">\n'.format(
+                d, rng.randrange(100), rng.randrange(1900, 2020)))
+            for s in range(sents):
+                if s % 10 == 0:
+                    fh.write("<p>\n")
+                fh.write('<s id="d{}s{}" n="{}">\n'.format(
+                    d, s, rng.randrange(10)))
+                for _ in range(rng.randrange(5, 30)):
+                    word = rng.choice(words)
+                    fh.write("{}\t{}\tNN\n".format(word, word.upper()))
+                fh.write("</s>\n")
+                if s % 10 == 9 or s == sents - 1:
+                    fh.write("</p>\n")
+            fh.write("</doc>\n")
+
+
+def run_cli(path, command, threads):
+    vrt.vrt.main(["-i", path, "-o", os.devnull, "-l", "WARNING",
+                  "--threads", str(threads), command] + ARGS[command],
+                 standalone_mode=False)
+
+
+def _run_structure(command, raw):
+    return "".join(vrt.API[command](vrt.linewise(raw), **COMMANDS[command]))
+
+
+def run_processes(path, command, pool):
+    work = functools.partial(_run_structure, command)
+    with open(path, encoding="utf-8") as fh, \
+            open(os.devnull, "w", encoding="utf-8") as out:
+        raws = (s.raw for s in pyvert.iterstruct(fh, struct="doc"))
+        for output in pool.imap(work, raws, chunksize=4):
+            out.write(output)
+
+
+def measure(func, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("-i", "--input", default=None,
+                        help="Vertical to use instead of a generated one.")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="Number of threads and processes.")
+    parser.add_argument("-d", "--docs", type=int, default=200,
+                        help="Number of documents to generate.")
+    parser.add_argument("-s", "--sents", type=int, default=200,
+                        help="Number of sentences per generated document.")
+    parser.add_argument("-r", "--repeat", type=int, default=3,
+                        help="Number of runs per command and mode.")
+    parser.add_argument("-c", "--command", choices=sorted(COMMANDS),
+                        action="append", help="Commands to run (default: all).")
+    args = parser.parse_args()
+    # the structures are known in advance, as they would be in production
+    pyvert.config(structs=["doc", "p", "s"])
+    with tempfile.TemporaryDirectory() as tmp:
+        path = args.input
+        if path is None:
+            path = os.path.join(tmp, "bench.vrt")
+            generate(path, args.docs, args.sents)
+        print("{} MiB, {} jobs".format(
+            os.path.getsize(path) // 2 ** 20, args.jobs))
+        print("{:<10} {:>10} {:>10} {:>10}".format(
+            "command", "single", "threads", "processes"))
+        with multiprocessing.Pool(args.jobs) as pool:
+            for command in args.command or sorted(COMMANDS):
+                single = measure(lambda: run_cli(path, command, 1),
+                                 args.repeat)
+                threads = measure(lambda: run_cli(path, command, args.jobs),
+                                  args.repeat)
+                processes = measure(lambda: run_processes(path, command, pool),
+                                    args.repeat)
+                print("{:<10} {:>9.2f}s {:>9.2f}s {:>9.2f}s".format(
+                    command, single, threads, processes))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
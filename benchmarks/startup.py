@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""Measure the startup latency of the ``vrt`` command line interface.
+
+Each command is run repeatedly on a tiny input in a fresh interpreter and the
+median wall clock time is compared to a target latency. The exit code is
+non-zero if any command misses the target, so the script can be run as part
+of CI:
+
+    python benchmarks/startup.py --target 0.25
+
+"""
+
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+COMMANDS = [
+    ["--help"],
+    ["strip"],
+    ["unescape"],
+    ["filter", "-a", "id", "1"],
+]
+INPUT = b'<doc id="1">\nfoo\tbar\n&amp;\n</doc>\n'
+VRT = "from pyvert.vrt import vrt; vrt()"
+
+
+def measure(args, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", VRT] + args, input=INPUT,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("-t", "--target", type=float, default=0.25,
+                        help="Target median latency in seconds.")
+    parser.add_argument("-r", "--repeat", type=int, default=10,
+                        help="Number of runs per command.")
+    args = parser.parse_args()
+    # the interpreter itself is a lower bound on what can be achieved
+    baseline = measure_python(args.repeat)
+    print("{:<30} {:>8.3f}s".format("python -c pass", baseline))
+    missed = False
+    for command in COMMANDS:
+        latency = measure(command, args.repeat)
+        ok = latency <= args.target
+        missed |= not ok
+        print("{:<30} {:>8.3f}s {}".format(
+            "vrt " + " ".join(command), latency, "" if ok else "(slow)"))
+    return 1 if missed else 0
+
+
+def measure_python(repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,16 @@
-import pkg_resources
 from ._pyvert import *
+from ._compiled import *
+from ._columns import *
 
-try:
-    __version__ = pkg_resources.get_distribution(__name__).version
-except:
-    __version__ = 'unknown'
+
+def __getattr__(name):
+    # looking up the version is slow, so it's only done when it's needed
+    if name == "__version__":
+        from importlib.metadata import version, PackageNotFoundError
+        try:
+            globals()[name] = version(__name__)
+        except PackageNotFoundError:
+            globals()[name] = 'unknown'
+        return globals()[name]
+    raise AttributeError("module {!r} has no attribute {!r}".format(
+        __name__, name))
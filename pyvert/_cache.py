@@ -0,0 +1,116 @@
+import os
+import json
+import time
+import hashlib
+import logging
+from ._lazy import LazyModule
+
+sqlite3 = LazyModule("sqlite3")
+
+
+class StructCache:
+    """An on-disk cache of the output of a command for individual structures.
+
+    Entries are keyed by a hash of the raw text of the structure together
+    with ``prefix``, which should identify the command, its parameters and the
+    version of pyvert. They are stored in an SQLite database in ``directory``,
+    along with the time they were last used; when the cache grows over
+    ``size`` bytes, the least recently used entries are evicted.
+
+    """
+    # commit after this many changes to the database
+    COMMIT_EVERY = 1000
+
+    def __init__(self, directory, prefix, size=2 ** 30, command=None):
+        os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(directory, "cache.sqlite"))
+        self.db.execute("CREATE TABLE IF NOT EXISTS cache (key BLOB PRIMARY "
+                        "KEY, value BLOB, size INTEGER, used REAL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS cache_used ON cache (used)")
+        self.prefix = prefix.encode("utf-8")
+        self.size = size
+        self.command = command
+        self.total = self.db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        self.hits = self.misses = 0
+        self._changes = 0
+
+    @classmethod
+    def for_command(cls, directory, command, params, version, **kwargs):
+        prefix = json.dumps([command, params, version], sort_keys=True,
+                            default=str)
+        return cls(directory, prefix, command=command, **kwargs)
+
+    def key(self, raw, extra=""):
+        """The cache key of structure ``raw``; ``extra`` is for any other data
+        the output depends on (e.g. the ordinal of the structure).
+
+        """
+        h = hashlib.blake2b(self.prefix, digest_size=16)
+        h.update(extra.encode("utf-8"))
+        h.update(b"\0")
+        h.update(raw.encode("utf-8", errors="surrogatepass"))
+        return h.digest()
+
+    def get(self, key):
+        row = self.db.execute("SELECT value FROM cache WHERE key = ?",
+                              (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.db.execute("UPDATE cache SET used = ? WHERE key = ?",
+                        (time.time(), key))
+        self._changed()
+        return row[0].decode("utf-8", errors="surrogatepass")
+
+    def put(self, key, value):
+        value = value.encode("utf-8", errors="surrogatepass")
+        self.db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                        (key, value, len(value), time.time()))
+        self.total += len(value)
+        if self.total > self.size:
+            self._evict()
+        self._changed()
+
+    def _changed(self):
+        self._changes += 1
+        if self._changes % self.COMMIT_EVERY == 0:
+            self.db.commit()
+
+    def _evict(self):
+        # make some room at once so that eviction doesn't happen on each put
+        target = self.size * 0.9
+        rows = self.db.execute("SELECT key, size FROM cache ORDER BY used")
+        evicted = []
+        for key, size in rows:
+            if self.total <= target:
+                break
+            evicted.append((key,))
+            self.total -= size
+        self.db.executemany("DELETE FROM cache WHERE key = ?", evicted)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+        lookups = self.hits + self.misses
+        logging.info("Cache: {} hits, {} misses ({:.1%} hit rate).".format(
+            self.hits, self.misses, self.hits / lookups if lookups else 0),
+            extra=dict(command=self.command))
+
+
+class DummyCache:
+    """Anamorphous to StructCache but never hits, for runs without caching.
+
+    """
+    def key(self, raw, extra=""):
+        return None
+
+    def get(self, key):
+        return None
+
+    def put(self, key, value):
+        pass
+
+    def close(self):
+        pass
@@ -0,0 +1,142 @@
+import os
+import json
+
+
+class CountingReader:
+    """Iterate over the decoded lines of a binary file while keeping track of
+    the byte offset of the first line which hasn't been read yet.
+
+    Unlike ``tell()`` on a text file, the offset can be queried in the middle
+    of an iteration.
+
+    """
+    def __init__(self, buffer, encoding="utf-8", errors="strict"):
+        self.buffer = buffer
+        self.encoding = encoding
+        self.errors = errors
+        self.offset = buffer.tell()
+
+    def __iter__(self):
+        for line in self.buffer:
+            self.offset += len(line)
+            yield line.decode(self.encoding, self.errors)
+
+    def read(self):
+        data = self.buffer.read()
+        self.offset += len(data)
+        return data.decode(self.encoding, self.errors)
+
+
+class Checkpoint:
+    """Record how far a command got in processing its input, so that an
+    interrupted run can be resumed.
+
+    Commands call ``mark()`` after the output corresponding to a unit of input
+    (typically a structure) has been yielded, passing along any state they
+    need to continue from that point. Every ``every`` marks, the input byte
+    offset, the ordinal of the unit, the number of output bytes written and
+    the state are saved to ``path``. The file is replaced atomically and the
+    output is synced to disk first, so the checkpoint never points past what
+    was actually written.
+
+    """
+    def __init__(self, path, reader, output, every=1000, key=None):
+        self.path = path
+        self.reader = reader
+        self.output = output
+        self.every = every
+        self.key = key
+        self.written = 0
+        self.ordinal = -1
+        self.state = {}
+        # input offset and output length as of the last mark
+        self.offset = reader.offset
+        self.marked_written = 0
+        self._marks = self._saved_marks = 0
+
+    @staticmethod
+    def load(path):
+        """Load a saved checkpoint, or return None if there is none.
+
+        """
+        try:
+            with open(path, encoding="utf-8") as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return None
+
+    def resume(self, saved):
+        """Restore the position and state recorded in ``saved``.
+
+        The caller is responsible for seeking the input and truncating the
+        output accordingly.
+
+        """
+        if saved["key"] != self.key:
+            raise RuntimeError(
+                "Checkpoint {} was recorded for a different command, different "
+                "parameters or a different input.".format(self.path))
+        self.written = self.marked_written = saved["written"]
+        self.offset = saved["offset"]
+        self.ordinal = saved["ordinal"]
+        self.state = saved["state"]
+
+    @property
+    def start(self):
+        """The ordinal of the first unit of input still to process.
+
+        """
+        return self.ordinal + 1
+
+    def write(self, data):
+        self.output.write(data)
+        self.written += len(data)
+
+    def mark(self, ordinal, **state):
+        self.ordinal = ordinal
+        self.state = state
+        self.offset = self.reader.offset
+        self.marked_written = self.written
+        self._marks += 1
+        if self._marks % self.every == 0:
+            self.save()
+
+    def save(self):
+        """Save the position as of the last mark, if it wasn't saved yet.
+
+        """
+        if self._marks == self._saved_marks:
+            return
+        self._saved_marks = self._marks
+        self.output.flush()
+        os.fsync(self.output.fileno())
+        saved = dict(key=self.key, offset=self.offset, ordinal=self.ordinal,
+                     written=self.marked_written, state=self.state)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump(saved, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, self.path)
+
+    def finish(self):
+        """Remove the checkpoint once the run has completed.
+
+        """
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class DummyCheckpoint:
+    """Anamorphous to Checkpoint but doesn't record anything, for runs without
+    checkpointing.
+
+    """
+    ordinal = -1
+    start = 0
+    state = {}
+
+    def mark(self, ordinal, **state):
+        pass
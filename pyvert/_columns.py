@@ -0,0 +1,155 @@
+from itertools import islice
+
+from ._pyvert import iterstruct
+
+__all__ = ["Vocabulary", "ColumnBatch", "itercolumns"]
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError as e:
+        raise RuntimeError(
+            "Columnar access to positional attributes needs NumPy; install it "
+            "with ``pip3 install --user numpy`` or as the ``columns`` extra "
+            "of pyvert.") from e
+    return numpy
+
+
+class Vocabulary:
+    """A growing mapping between the values of a positional attribute and
+    integer codes.
+
+    Share one vocabulary between all the structures of a corpus, so that
+    codes are comparable across them.
+
+    """
+    def __init__(self):
+        self.index = {}
+        self.strings = []
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __getitem__(self, code):
+        return self.strings[code]
+
+    def code(self, value):
+        """The code of ``value``, or None if it hasn't been seen yet.
+
+        """
+        return self.index.get(value)
+
+    def encode(self, values):
+        """Return an array of the codes of ``values``, adding the values to
+        the vocabulary as needed.
+
+        """
+        np = _numpy()
+        index, strings = self.index, self.strings
+        codes = []
+        for value in values:
+            code = index.get(value)
+            if code is None:
+                code = index[value] = len(strings)
+                strings.append(value)
+            codes.append(code)
+        return np.array(codes, dtype=np.uint32)
+
+    def decode(self, codes):
+        strings = self.strings
+        return [strings[code] for code in codes]
+
+
+class ColumnBatch:
+    """Positional attributes of a batch of structures as arrays of codes.
+
+    ``codes[i]`` is the array of codes of the ``i``-th requested column for
+    all positions in the batch, ``vocabularies[i]`` the vocabulary they refer
+    to. The positions of the ``j``-th structure are
+    ``offsets[j]:offsets[j + 1]``, its attributes are in ``attrs[j]``.
+
+    """
+    def __init__(self, codes, offsets, vocabularies, attrs):
+        self.codes = codes
+        self.offsets = offsets
+        self.vocabularies = vocabularies
+        self.attrs = attrs
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lengths(self):
+        """The number of positions in each structure.
+
+        """
+        return _numpy().diff(self.offsets)
+
+    def counts(self, column=0):
+        """The number of occurrences of each code of ``column`` in the batch,
+        as an array indexed by code.
+
+        """
+        np = _numpy()
+        return np.bincount(self.codes[column],
+                           minlength=len(self.vocabularies[column]))
+
+
+def _positions(raw):
+    for line in raw.split("\n"):
+        stripped = line.strip()
+        if not stripped or stripped[0] == "<" and stripped[-1] == ">":
+            continue
+        yield line
+
+
+def _encode(structures, columns, vocabularies):
+    np = _numpy()
+    values = [[] for _ in columns]
+    offsets = [0]
+    for structure in structures:
+        n = 0
+        for line in _positions(structure.raw):
+            cols = line.split("\t")
+            for vals, c in zip(values, columns):
+                vals.append(cols[c] if c < len(cols) else "")
+            n += 1
+        offsets.append(offsets[-1] + n)
+    codes = [vocab.encode(vals) for vocab, vals in zip(vocabularies, values)]
+    return codes, np.array(offsets, dtype=np.int64)
+
+
+def columns(structure, columns=(0,), vocabularies=None):
+    """Return the positional attributes ``columns`` of ``structure`` as a
+    ``ColumnBatch`` of a single structure.
+
+    If given, ``vocabularies`` (one per column) are used and extended,
+    otherwise new ones are created. Missing values are encoded as empty
+    strings.
+
+    """
+    if vocabularies is None:
+        vocabularies = [Vocabulary() for _ in columns]
+    codes, offsets = _encode([structure], columns, vocabularies)
+    return ColumnBatch(codes, offsets, vocabularies, [structure.attr])
+
+
+def itercolumns(vert_file, struct, columns=(0,), batch=1000,
+                vocabularies=None):
+    """Yield ``ColumnBatch``es of the positional attributes ``columns`` of
+    ``batch`` ``struct`` structures at a time.
+
+    All batches share the same ``vocabularies`` (one per column, new ones are
+    created if not given), so codes are comparable across batches.
+
+    """
+    if vocabularies is None:
+        vocabularies = [Vocabulary() for _ in columns]
+    structures = iterstruct(vert_file, struct=struct)
+    while True:
+        chunk = list(islice(structures, batch))
+        if not chunk:
+            return
+        codes, offsets = _encode(chunk, columns, vocabularies)
+        yield ColumnBatch(codes, offsets, vocabularies,
+                          [s.attr for s in chunk])
@@ -0,0 +1,431 @@
+import os
+import sys
+import json
+import mmap
+import shutil
+import weakref
+import tempfile
+from array import array
+from collections import deque
+from lazy import lazy
+
+from ._pyvert import Structure, Context, START_TAG, END_TAG, ATTR
+
+__all__ = ["Corpus", "compile_vertical", "is_compiled"]
+
+MAGIC = b"PYVERTC1"
+# id of a positional attribute missing on a line with fewer columns
+ABSENT = 0xFFFFFFFF
+ALIGN = 8
+
+
+def is_compiled(path):
+    """Check whether ``path`` is a compiled corpus.
+
+    """
+    try:
+        with open(path, "rb") as fh:
+            return fh.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+class _ArrayWriter:
+    """Append numbers to an array stored in a file, in batches.
+
+    """
+    BATCH = 2 ** 16
+
+    def __init__(self, path, typecode):
+        self.path = path
+        self.typecode = typecode
+        self.fh = open(path, "wb")
+        self.buffer = array(typecode)
+        self.count = 0
+
+    def append(self, value):
+        self.buffer.append(value)
+        self.count += 1
+        if len(self.buffer) >= self.BATCH:
+            self.flush()
+
+    def fill(self, value, n):
+        while n > 0:
+            batch = min(n, self.BATCH)
+            self.buffer.extend(array(self.typecode, [value]) * batch)
+            self.count += batch
+            n -= batch
+            self.flush()
+
+    def flush(self):
+        self.buffer.tofile(self.fh)
+        del self.buffer[:]
+
+    def close(self):
+        self.flush()
+        self.fh.close()
+
+
+class _StringTableWriter:
+    """Store strings as UTF-8 data and an array of their offsets.
+
+    """
+    def __init__(self, path):
+        self.data = open(path + ".data", "wb")
+        self.offsets = _ArrayWriter(path + ".offsets", "Q")
+        self.offsets.append(0)
+        self.size = 0
+
+    def add(self, string):
+        """Add a string and return its index.
+
+        """
+        data = string.encode("utf-8", errors="surrogatepass")
+        self.data.write(data)
+        self.size += len(data)
+        self.offsets.append(self.size)
+        return self.offsets.count - 2
+
+    def close(self):
+        self.data.close()
+        self.offsets.close()
+
+
+class _LexiconWriter(_StringTableWriter):
+    """A string table where each distinct string is stored once.
+
+    """
+    def __init__(self, path):
+        super().__init__(path)
+        self.ids = {}
+
+    def id(self, string):
+        id = self.ids.get(string)
+        if id is None:
+            id = self.ids[string] = self.add(string)
+        return id
+
+
+def compile_vertical(lines, path, tmpdir=None):
+    """Compile a vertical into a binary corpus stored at ``path``.
+
+    Each positional attribute gets a lexicon of its distinct values, and
+    positions are stored as arrays of ids into these lexicons. Markup lines
+    (structure tags and anything else which isn't a position) are stored
+    verbatim along with the position they precede, so that the original
+    vertical can be reproduced exactly. Each structure is recorded as its
+    start and end position and the indices of its start and end tag among
+    the markup lines.
+
+    """
+    out_dir = os.path.dirname(os.path.abspath(path))
+    with tempfile.TemporaryDirectory(prefix="pyvert-compile-",
+                                     dir=tmpdir or out_dir) as tmp:
+        def tmp_path(name):
+            return os.path.join(tmp, name)
+
+        markup = _StringTableWriter(tmp_path("markup"))
+        markup_pos = _ArrayWriter(tmp_path("markup.pos"), "Q")
+        columns = []
+        # name -> (record writer, records waiting for earlier ones to close)
+        structs = {}
+        stack = []
+        positions = 0
+
+        def flush_records(name):
+            writer, pending = structs[name]
+            while pending and pending[0][1] is not None:
+                for value in pending.popleft():
+                    writer.append(value)
+
+        def record(name, start_pos, start_idx):
+            if name not in structs:
+                writer = _ArrayWriter(tmp_path("struct." + name), "Q")
+                structs[name] = writer, deque()
+            rec = [start_pos, None, start_idx, None]
+            structs[name][1].append(rec)
+            return rec
+
+        for line in lines:
+            line = line.rstrip("\n")
+            stripped = line.strip()
+            if not stripped or stripped[0] == "<" and stripped[-1] == ">":
+                idx = markup.add(line)
+                markup_pos.append(positions)
+                e = END_TAG.fullmatch(stripped)
+                if e:
+                    name = e.group(1)
+                    # tolerate stray end tags, structures may have been cut
+                    for i in range(len(stack) - 1, -1, -1):
+                        if stack[i][0] == name:
+                            stack[i][1][1], stack[i][1][3] = positions, idx
+                            del stack[i]
+                            flush_records(name)
+                            break
+                    continue
+                s = START_TAG.fullmatch(stripped)
+                if s:
+                    name = s.group(1)
+                    rec = record(name, positions, idx)
+                    if s.group(3):
+                        rec[1], rec[3] = positions, idx
+                        flush_records(name)
+                    else:
+                        stack.append((name, rec))
+                continue
+            values = line.split("\t")
+            while len(columns) < len(values):
+                c = len(columns)
+                ids = _ArrayWriter(tmp_path("col{}".format(c)), "I")
+                ids.fill(ABSENT, positions)
+                columns.append((_LexiconWriter(tmp_path("lex{}".format(c))),
+                                ids))
+            for c, (lexicon, ids) in enumerate(columns):
+                ids.append(lexicon.id(values[c]) if c < len(values)
+                           else ABSENT)
+            positions += 1
+
+        # structures left open at the end extend to the end of the vertical
+        for name, rec in stack:
+            rec[1], rec[3] = positions, markup.offsets.count - 2
+        for name in structs:
+            flush_records(name)
+
+        sections = [("markup.data", "B"), ("markup.offsets", "Q"),
+                    ("markup.pos", "Q")]
+        for c in range(len(columns)):
+            sections += [("lex{}.data".format(c), "B"),
+                         ("lex{}.offsets".format(c), "Q"),
+                         ("col{}".format(c), "I")]
+        sections += [("struct." + name, "Q") for name in structs]
+        markup.close()
+        markup_pos.close()
+        for lexicon, ids in columns:
+            lexicon.close()
+            ids.close()
+        for writer, _ in structs.values():
+            writer.close()
+
+        header = dict(byteorder=sys.byteorder, positions=positions,
+                      columns=len(columns), markup=markup_pos.count,
+                      structs={name: writer.count // 4
+                               for name, (writer, _) in structs.items()},
+                      sections={})
+        offset = 0
+        for name, typecode in sections:
+            size = os.path.getsize(tmp_path(name))
+            header["sections"][name] = [offset, size, typecode]
+            offset += size + -size % ALIGN
+        header = json.dumps(header).encode("utf-8")
+        header += b" " * (-len(header) % ALIGN)
+        with open(path, "wb") as fh:
+            fh.write(MAGIC)
+            fh.write(len(header).to_bytes(8, "little"))
+            fh.write(header)
+            for name, _ in sections:
+                with open(tmp_path(name), "rb") as section:
+                    shutil.copyfileobj(section, fh)
+                fh.write(b"\0" * (-fh.tell() % ALIGN))
+
+
+class Lexicon:
+    """The strings in a string table of a compiled corpus.
+
+    """
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, id):
+        return str(self.data[self.offsets[id]:self.offsets[id + 1]], "utf-8",
+                   "surrogatepass")
+
+    @lazy
+    def ids(self):
+        """A mapping of strings to their ids.
+
+        """
+        return {self[id]: id for id in range(len(self))}
+
+
+class CompiledStructure(Structure):
+    """A structure in a compiled corpus.
+
+    Its name and attributes are read from its start tag only; its ``raw``
+    text (and everything derived from it) is reconstructed on demand, so
+    structures which are e.g. filtered out by their attributes cost little.
+
+    """
+    def __init__(self, corpus, record, structs):
+        self.corpus = corpus
+        self.record = record
+        self.structs = structs
+        start_tag = corpus.markup[record[2]].strip()
+        self.name = START_TAG.match(start_tag).group(1)
+        self.attr = dict(ATTR.findall(start_tag))
+
+    @lazy
+    def raw(self):
+        start, end, start_idx, end_idx = self.record
+        lines = self.corpus.lines(start=start, end=end, markup_start=start_idx,
+                                  markup_end=end_idx + 1)
+        return "".join(line.strip() + "\n" for line in lines)
+
+
+class Corpus:
+    """A compiled corpus, memory-mapped.
+
+    Iterating over it yields the lines of the original vertical, so it can be
+    used in place of a file handle wherever a vertical is expected, and
+    ``iterstruct()`` on it only reconstructs the structures which are asked
+    for.
+
+    """
+    def __init__(self, path):
+        self.name = path
+        with open(path, "rb") as fh:
+            self._mmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+        # views of sections handed out, to be released on close()
+        self._views = []
+        if self._view[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise RuntimeError("{} is not a compiled corpus.".format(path))
+        size = int.from_bytes(self._view[8:16], "little")
+        header = json.loads(str(self._view[16:16 + size], "utf-8"))
+        if header["byteorder"] != sys.byteorder:
+            self.close()
+            raise RuntimeError("{} was compiled on a machine with a different "
+                               "byte order.".format(path))
+        self._base = 16 + size
+        self._sections = header["sections"]
+        self.positions = header["positions"]
+        self.structs = header["structs"]
+        self.markup = Lexicon(self._section("markup.data"),
+                              self._section("markup.offsets"))
+        self.markup_pos = self._section("markup.pos")
+        self.lexicons = [Lexicon(self._section("lex{}.data".format(c)),
+                                 self._section("lex{}.offsets".format(c)))
+                         for c in range(header["columns"])]
+        self.ids = [self._section("col{}".format(c))
+                    for c in range(header["columns"])]
+
+    def _section(self, name):
+        offset, size, typecode = self._sections[name]
+        offset += self._base
+        view = self._view[offset:offset + size].cast(typecode)
+        self._views = [ref for ref in self._views if ref() is not None]
+        self._views.append(weakref.ref(view))
+        return view
+
+    def records(self, struct):
+        """Yield the (start position, end position, start tag index, end tag
+        index) records of ``struct`` structures in the order of their start.
+
+        """
+        if struct not in self.structs:
+            return
+        records = self._section("struct." + struct)
+        for i in range(0, len(records), 4):
+            yield tuple(records[i:i + 4])
+
+    def lines(self, columns=None, start=0, end=None, markup_start=0,
+              markup_end=None):
+        """Yield lines of the vertical (with the positional attributes in
+        ``columns`` only, if given) between positions ``start`` and ``end``
+        and markup lines ``markup_start`` and ``markup_end``.
+
+        """
+        end = self.positions if end is None else end
+        markup_end = len(self.markup) if markup_end is None else markup_end
+        if columns is None:
+            columns = range(len(self.ids))
+        cols = [(self.ids[c], self.lexicons[c]) for c in columns]
+        markup, markup_pos = self.markup, self.markup_pos
+        pos = start
+        for idx in range(markup_start, markup_end):
+            before = markup_pos[idx]
+            while pos < before:
+                yield self._position(cols, pos)
+                pos += 1
+            yield markup[idx] + "\n"
+        while pos < end:
+            yield self._position(cols, pos)
+            pos += 1
+
+    @staticmethod
+    def _position(cols, pos):
+        values = []
+        for ids, lexicon in cols:
+            id = ids[pos]
+            if id != ABSENT:
+                values.append(lexicon[id])
+        return "\t".join(values) + "\n"
+
+    def __iter__(self):
+        return self.lines()
+
+    def read(self):
+        return "".join(self.lines())
+
+    def iterstruct(self, struct=None, structs=None, context=()):
+        """Like ``pyvert.iterstruct()``, which delegates to this when given a
+        compiled corpus.
+
+        """
+        structs = set(structs) if structs else set(self.structs)
+        if struct is None:
+            structs.add("root")
+            yield Structure("<root>\n" + self.read().strip() + "\n</root>",
+                            structs)
+            return
+        # records of the enclosing structures, and those of each name which
+        # have started but not yet ended
+        pending = {name: self.records(name) for name in context}
+        heads = {name: next(records, None)
+                 for name, records in pending.items()}
+        open_ = {name: [] for name in context}
+        for record in self.records(struct):
+            structure = CompiledStructure(self, record, structs)
+            if context:
+                start_idx = record[2]
+                for name in context:
+                    head = heads[name]
+                    while head is not None and head[2] < start_idx:
+                        open_[name].append(
+                            (head, CompiledStructure(self, head, structs)))
+                        head = next(pending[name], None)
+                    heads[name] = head
+                    open_[name] = [(r, s) for r, s in open_[name]
+                                   if r[3] > start_idx]
+                enclosing = sorted((r[2], s) for name in context
+                                   for r, s in open_[name])
+                structure.context = tuple(Context(s.name, s.attr)
+                                          for _, s in enclosing)
+            yield structure
+
+    def close(self):
+        """Unmap the corpus. Never raises: if the memory is still exported
+        (e.g. to a numpy array), unmapping is left to the garbage collector.
+
+        """
+        for attr in ("markup", "markup_pos", "lexicons", "ids"):
+            self.__dict__.pop(attr, None)
+        try:
+            for ref in self._views:
+                view = ref()
+                if view is not None:
+                    view.release()
+            self._view.release()
+            self._mmap.close()
+        except BufferError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
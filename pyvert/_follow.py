@@ -0,0 +1,87 @@
+import os
+import time
+import logging
+
+from ._checkpoint import CountingReader
+
+
+class FollowReader(CountingReader):
+    """Iterate over the lines of a file which is still being written to,
+    waiting for more data at EOF instead of stopping (like ``tail -f``).
+
+    A line is only yielded once it's complete (i.e. its newline has
+    arrived). Every ``interval`` seconds without new data, the file is checked
+    for truncation (reading starts over from the beginning) and rotation
+    (``path`` now refers to a different file, which is opened and read from
+    the beginning), and the ``idle`` callback, if any, is called. If
+    ``timeout`` is given, iteration (and ``read()``) stops after that many
+    seconds without new data.
+
+    """
+    def __init__(self, path, buffer, encoding="utf-8", errors="strict",
+                 interval=1.0, timeout=None, idle=None):
+        super().__init__(buffer, encoding, errors)
+        self.path = path
+        self.interval = interval
+        self.timeout = timeout
+        self.idle = idle
+
+    def __iter__(self):
+        pending = b""
+        waited = 0
+        while True:
+            line = self.buffer.readline()
+            if line:
+                waited = 0
+                pending += line
+                if not pending.endswith(b"\n"):
+                    continue
+                self.offset += len(pending)
+                yield pending.decode(self.encoding, self.errors)
+                pending = b""
+                continue
+            if self._reopened():
+                if pending:
+                    # the last line of the old file didn't have a newline
+                    yield pending.decode(self.encoding, self.errors)
+                    pending = b""
+                continue
+            if self.timeout is not None and waited >= self.timeout:
+                if pending:
+                    self.offset += len(pending)
+                    yield pending.decode(self.encoding, self.errors)
+                return
+            if self.idle is not None:
+                self.idle()
+            time.sleep(self.interval)
+            waited += self.interval
+
+    def read(self):
+        """Read all lines until the ``timeout`` expires (or forever).
+
+        """
+        return "".join(self)
+
+    def _reopened(self):
+        """Check whether the file was truncated or rotated and if so, start
+        reading from the beginning of the (new) file.
+
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            # rotated, but the new file hasn't been created yet
+            return False
+        if stat.st_ino != os.fstat(self.buffer.fileno()).st_ino:
+            logging.warning("{} was rotated, reading the new file.".format(
+                self.path), extra=dict(command="follow"))
+            self.buffer.close()
+            self.buffer = open(self.path, "rb")
+        elif stat.st_size < self.buffer.tell():
+            logging.warning("{} was truncated, reading from the start.".format(
+                self.path), extra=dict(command="follow"))
+            self.buffer.seek(0)
+        else:
+            return False
+        self.offset = 0
+        return True
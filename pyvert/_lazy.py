@@ -0,0 +1,23 @@
+import importlib
+
+
+class LazyModule:
+    """A stand-in for a module which only imports it when one of its
+    attributes is first accessed.
+
+    Used for modules which are slow to import and which only some commands
+    need, so that the others start up faster. After the import, the module's
+    attributes are copied over, so later accesses cost no more than accessing
+    the module itself.
+
+    """
+    def __init__(self, name):
+        self.__name = name
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self.__name)
+        self.__dict__.update(module.__dict__)
+        return getattr(module, attr)
+
+    def __repr__(self):
+        return "<lazy module {!r}>".format(self.__name)
@@ -0,0 +1,107 @@
+import os
+import tempfile
+import itertools
+from ._lazy import LazyModule
+
+sqlite3 = LazyModule("sqlite3")
+
+
+class MemoryTable:
+    """Rows of a metadata table, indexed by key in a dict.
+
+    Each row is kept as a single string of tab-separated values, which takes
+    several times less memory than a list of them.
+
+    """
+    def __init__(self, names):
+        self.names = names
+        self.rows = {}
+
+    def update(self, rows):
+        self.rows.update(rows)
+
+    def get(self, key):
+        row = self.rows.get(key)
+        return None if row is None else row.split("\t")
+
+    def close(self):
+        pass
+
+
+class DiskTable:
+    """Rows of a metadata table, indexed by key in a temporary SQLite
+    database in ``tmpdir``, for tables which don't fit into memory.
+
+    """
+    # insert this many rows at a time
+    BATCH = 10000
+
+    def __init__(self, names, tmpdir=None):
+        self.names = names
+        self.dir = tempfile.TemporaryDirectory(prefix="pyvert-annotate-",
+                                               dir=tmpdir)
+        self.db = sqlite3.connect(os.path.join(self.dir.name, "index.sqlite"))
+        # the database is thrown away if anything goes wrong anyway
+        self.db.execute("PRAGMA journal_mode = OFF")
+        self.db.execute("PRAGMA synchronous = OFF")
+        self.db.execute("CREATE TABLE rows (key TEXT PRIMARY KEY, row TEXT) "
+                        "WITHOUT ROWID")
+
+    def update(self, rows):
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, self.BATCH))
+            if not batch:
+                break
+            self.db.executemany("INSERT OR REPLACE INTO rows VALUES (?, ?)",
+                                batch)
+        self.db.commit()
+
+    def get(self, key):
+        row = self.db.execute("SELECT row FROM rows WHERE key = ?",
+                              (key,)).fetchone()
+        return None if row is None else row[0].split("\t")
+
+    def close(self):
+        self.db.close()
+        self.dir.cleanup()
+
+
+def load_table(path, memory=2 ** 29, tmpdir=None, encoding="utf-8"):
+    """Load the metadata table in TSV file ``path``, whose first row holds the
+    column names and whose first column holds the keys.
+
+    The table is indexed in memory if it looks like it fits into ``memory``
+    bytes, otherwise on disk in ``tmpdir``. If a key occurs more than once,
+    its last row wins.
+
+    """
+    with open(path, encoding=encoding) as fh:
+        header = fh.readline().rstrip("\r\n").split("\t")
+        if len(header) < 2:
+            raise RuntimeError("The metadata table {} needs a key column and "
+                               "at least one more.".format(path))
+        names = header[1:]
+        # a dict takes up roughly twice as much memory as the text it holds
+        if 2 * os.path.getsize(path) <= memory:
+            table = MemoryTable(names)
+        else:
+            table = DiskTable(names, tmpdir)
+        try:
+            table.update(_rows(fh, path, len(header)))
+        except BaseException:
+            table.close()
+            raise
+    return table
+
+
+def _rows(fh, path, columns):
+    for i, line in enumerate(fh, start=2):
+        line = line.rstrip("\r\n")
+        if not line:
+            continue
+        key, _, row = line.partition("\t")
+        if row.count("\t") != columns - 2:
+            raise RuntimeError("Line {} of {} doesn't have {} columns.".format(
+                i, path, columns))
+        yield key, row
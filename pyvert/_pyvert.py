@@ -1,31 +1,64 @@
 from itertools import chain
+from collections import namedtuple
 from lazy import lazy
 from tempfile import NamedTemporaryFile as NamedTempFile
 
-import regex as re
+import re as _re
 import random
-from lxml import etree
+import threading
 from html import unescape
+from ._lazy import LazyModule
+
+# these are slow to import and not needed by all commands
+re = LazyModule("regex")
+etree = LazyModule("lxml.etree")
 
 __all__ = ["Structure", "iterstruct", "config"]
 __version__ = "0.0.0"
 
-# disable security preventing DoS attacks with huge files
-etree.set_default_parser(etree.ETCompatXMLParser(huge_tree=True))
-
 STRUCTS = None
+# number of lines fed to the parser at once when building trees incrementally
+FEED_LINES = 1000
+
+# patterns for recognizing structure tags when reading a vertical line by
+# line; they're needed at import time, so they're compiled with the standard
+# library re module (which click imports anyway) rather than regex
+START_TAG = _re.compile(r"<(\w+)(.*?)(/?)>")
+END_TAG = _re.compile(r"</(\w+)\s*>")
+ATTR = _re.compile(r'(\w+)="(.*?)"')
+
+_local = threading.local()
+
+# an enclosing structure of a structure yielded by iterstruct()
+Context = namedtuple("Context", ["name", "attr"])
+
+
+def _parser():
+    """Return an XML parser with the security preventing DoS attacks with
+    huge files disabled.
+
+    lxml parsers can't be shared between threads, so each thread gets its own.
+
+    """
+    parser = getattr(_local, "parser", None)
+    if parser is None:
+        parser = _local.parser = etree.ETCompatXMLParser(huge_tree=True)
+    return parser
 
 
 class Structure():
     """A structure extracted from a vertical.
 
     """
+    # the enclosing structures requested from iterstruct(), outermost first
+    context = ()
+
     def __init__(self, raw_vert, structs):
         self.raw = raw_vert.strip() + "\n"
         self.structs = structs
         first_line = self.raw.split("\n", maxsplit=1)[0]
         self.name = re.search(r"\w+", first_line).group()
-        self.attr = dict(re.findall(r'(\w+)="(.*?)"', first_line))
+        self.attr = dict(ATTR.findall(first_line))
 
     @lazy
     def xml(self):
@@ -34,18 +67,27 @@ class Structure():
         """
         xml = self._xmlize()
         try:
-            xml = etree.fromstring(xml)
+            xml = etree.fromstring(xml, parser=_parser())
             xml.tail = "\n"
             return xml
         except etree.XMLSyntaxError as e:
-            with NamedTempFile(mode="w", suffix=".xml", delete=False) as fh:
-                fh.write(xml)
-            e = str(e)
-            e += "\nAn XMLSyntaxError occurred while processing a document. " \
-                 "It has been dumped to {} for inspection.".format(fh.name)
-            raise Exception(e)
-
-    def chunk(self, child, name, minmax, fallback_orig_id=None):
+            raise _syntax_error(xml, e)
+
+    def columns(self, columns=(0,), vocabularies=None):
+        """The positional attributes ``columns`` of the structure as arrays of
+        integer codes.
+
+        :param columns: Indices of the positional attributes to extract.
+        :param vocabularies: One ``Vocabulary`` per column, mapping values to
+            codes; share them between structures to get comparable codes.
+        :rtype: pyvert.ColumnBatch
+
+        """
+        # imported here because _columns itself builds on this module
+        from ._columns import columns as _columns
+        return _columns(self, columns, vocabularies)
+
+    def chunk(self, child, name, minmax, fallback_orig_id=None, rng=random):
         """Split the structure into chunks of a given size.
 
         :param name: The name to give to the XML element representing the
@@ -59,6 +101,9 @@ class Structure():
         :type minmax: (int, int)
         :param fallback_orig_id: If structure has no @id attribute, this will
             be used instead to generate the @ids of the chunks.
+        :param rng: The random number generator to draw chunk lengths from;
+            give each thread its own ``random.Random`` when chunking
+            structures concurrently.
         :rtype: etree.Element
 
         """
@@ -83,7 +128,7 @@ class Structure():
         def loop_vars(name, attrib, minmax):
             chunk = etree.Element(name, attrib=attrib)
             chunk.text = chunk.tail = "\n"
-            chunk_length = random.randint(*minmax)
+            chunk_length = rng.randint(*minmax)
             return chunk, chunk_length, 0
 
         chunk, chunk_length, positions = loop_vars(name, root.attrib, minmax)
@@ -191,27 +236,85 @@ class Structure():
         attrib = self.xml.attrib
         for child in self.xml.iter(child):
             for key in attrib:
-                ckey = self.name + "_" + key
-                while ckey in child.attrib:
-                    ckey += "_"
-                if key not in child.attrib:
+                ckey = _projected_key(key, self.name + "_", child.attrib)
+                if ckey is not None:
                     child.attrib[ckey] = attrib[key]
 
     def _xmlize(self):
         """Transform vertical into marginally valid XML.
 
         """
-        # get rid of all XML entities and HTML entity references
-        vert = unescape(self.raw)
-        # escape only the bare minimum necessary for successful parsing as XML
-        vert = re.sub(r"&", r"&amp;", vert)
-        vert = re.sub(r"<", "&lt;", vert)
-        vert = re.sub(r">", "&gt;", vert)
-        # now put pointy brackets back where they belong (= only on lines which
-        # we are reasonably sure are structure start / end tags)
-        match = r"^&lt;(/?({})[^\t]*?)&gt;$".format("|".join(self.structs))
-        vert = re.sub(match, r"<\1>", vert, flags=re.M)
-        return vert
+        return _xmlize(self.raw, _tags(self.structs))
+
+
+class ParsedStructure(Structure):
+    """A structure whose tree was built while it was being read.
+
+    Its name and attributes are taken from the tree; its ``raw`` text is
+    only available if it was kept.
+
+    """
+    def __init__(self, xml, structs, raw=None):
+        xml.tail = "\n"
+        self.xml = xml
+        self.structs = structs
+        self.name = xml.tag
+        self.attr = dict(xml.attrib)
+        if raw is not None:
+            self.raw = raw
+
+    @lazy
+    def raw(self):
+        raise RuntimeError("The raw text of <{}> wasn't kept; pass keep_raw=True "
+                           "to iterstruct() if it's needed.".format(self.name))
+
+
+def _syntax_error(xml, error):
+    """Dump ``xml``, which failed to parse with ``error``, to a temporary file
+    and return an exception pointing to it.
+
+    """
+    with NamedTempFile(mode="w", suffix=".xml", delete=False) as fh:
+        fh.write(xml)
+    e = str(error)
+    e += "\nAn XMLSyntaxError occurred while processing a document. " \
+         "It has been dumped to {} for inspection.".format(fh.name)
+    return Exception(e)
+
+
+def _tags(structs):
+    """Return a pattern matching the (escaped) start and end tags of
+    ``structs``.
+
+    """
+    return re.compile(r"^&lt;(/?({})[^\t]*?)&gt;$".format("|".join(structs)),
+                      flags=re.M)
+
+
+def _projected_key(key, prefix, attrib):
+    """Return the name under which attribute ``key`` is projected onto a
+    structure with attributes ``attrib``: prefixed with ``prefix`` and if
+    necessary, postfixed with underscores so as to avoid collisions. Return
+    None if the structure already has ``key`` itself, in which case it's not
+    projected.
+
+    """
+    if key in attrib:
+        return None
+    key = prefix + key
+    while key in attrib:
+        key += "_"
+    return key
+
+
+def _xmlize(vert, tags):
+    # get rid of all XML entities and HTML entity references
+    vert = unescape(vert)
+    # escape only the bare minimum necessary for successful parsing as XML
+    vert = vert.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
+    # now put pointy brackets back where they belong (= only on lines which
+    # we are reasonably sure are structure start / end tags)
+    return tags.sub(r"<\1>", vert)
 
 
 class ValidTags:
@@ -257,16 +360,29 @@ class DummyValidTags:
         return self.structs
 
 
-def iterstruct(vert_file, struct=None, structs=None):
+def iterstruct(vert_file, struct=None, structs=None, incremental=False,
+               keep_raw=False):
     """Yield input vertical one struct at a time.
 
-    :param vert_file: Input vertical.
+    :param vert_file: Input vertical (an iterable of lines, such as a file
+        handle, or a compiled ``Corpus``).
     :param struct: The name of the struct into which the vertical will be
         chopped. If None, the whole vertical is returned, wrapped in a
-        ``<root/>`` element.
+        ``<root/>`` element. If a sequence of names, structures are chopped
+        by the last one, and the names and attributes of the enclosing
+        structures named by the others are available in their ``context``
+        (a tuple of ``Context(name, attr)``, outermost first), without
+        buffering anything but the current structure.
     :param structs: A set of tag names to be considered as valid nested
         structures under ``struct``. When in doubt, leave ``None`` (automatic
         discovery), otherwise those you missed might be XML-escaped.
+    :param incremental: Build the XML tree of each structure while reading
+        it, line by line, instead of keeping its text and parsing it when
+        ``.xml`` is first accessed. Saves memory for commands which work
+        with the tree. When ``structs`` aren't given, the first structure is
+        read the regular way to discover them.
+    :param keep_raw: Keep the text of incrementally built structures in
+        ``.raw`` too.
     :rtype: Structure
 
     """
@@ -274,18 +390,30 @@ def iterstruct(vert_file, struct=None, structs=None):
     # might not be set, in which case this is a no-op)
     if structs is None:
         structs = STRUCTS
+    if struct is None or isinstance(struct, str):
+        context = ()
+    else:
+        *context, struct = struct
+
+    # compiled corpora know where their structures are
+    if hasattr(vert_file, "iterstruct"):
+        yield from vert_file.iterstruct(struct, structs, context)
+        return
 
     # if the whole input vertical is to be wrapped and structs were provided,
     # we can take a shortcut
-    if struct is None and structs:
-        structs.add("root")
+    if struct is None and structs and not incremental:
+        structs = set(structs) | {"root"}
         yield Structure("<root>\n" + vert_file.read().strip() + "\n</root>", structs)
-        raise StopIteration
+        return
     # else, we'll just surround the vertical with <root/> tags and go the
     # regular way (line by line)
     elif struct is None:
         struct = "root"
         vert_file = chain(["<root>"], vert_file, ["</root>"])
+        if structs:
+            # the wrapper must be recognized as a tag when xmlizing
+            structs = set(structs) | {"root"}
 
     # NOTE: string concatenation inside a for-loop is supposedly slow in
     # python, but building and then joining lists was comparably slow (mostly
@@ -293,11 +421,68 @@ def iterstruct(vert_file, struct=None, structs=None):
     # difference (in terms of the number of concatenations / length of the list
     # required), there's no real incentive to change this code
     buffer = ""
+    # pattern for xmlizing lines in incremental mode, once structs are known
+    tags = _tags(structs) if incremental and structs else None
+    # lxml's feed parser, while an incrementally built structure is open
+    parser = None
+    # the enclosing structures named in context
+    stack = []
     structs = DummyValidTags(structs) if structs else ValidTags()
     start = re.compile(r"<{}.*?>".format(struct))
     end = re.compile(r"</{}>".format(struct))
     for line in vert_file:
         line = line.strip()
+        if parser is not None:
+            if keep_raw:
+                buffer += line + "\n"
+            closed = end.fullmatch(line)
+            # most lines are positions with nothing to escape
+            if "&" in line or "<" in line or ">" in line:
+                line = _xmlize(line, tags)
+            pending.append(line)
+            # feeding the parser line by line would be slow
+            if closed or len(pending) >= FEED_LINES:
+                pending.append("")
+                fed.append("\n".join(pending))
+                pending = []
+                try:
+                    parser.feed(fed[-1])
+                    xml = parser.close() if closed else None
+                except etree.XMLSyntaxError as e:
+                    raise _syntax_error("".join(fed), e)
+            if closed:
+                parser = None
+                fed = []
+                structure = ParsedStructure(xml, structs.resolve(),
+                                            buffer if keep_raw else None)
+                structure.context = tuple(stack)
+                yield structure
+                buffer = ""
+            continue
+        if context and not buffer:
+            s = START_TAG.fullmatch(line)
+            if s and s.group(1) in context:
+                if not s.group(3):
+                    stack.append(Context(s.group(1),
+                                         dict(ATTR.findall(s.group(2)))))
+                continue
+            e = END_TAG.fullmatch(line)
+            if e and e.group(1) in context:
+                # tolerate stray end tags, structures may have been cut
+                for i in range(len(stack) - 1, -1, -1):
+                    if stack[i].name == e.group(1):
+                        del stack[i:]
+                        break
+                continue
+        if tags is not None and start.fullmatch(line):
+            parser = etree.ETCompatXMLParser(huge_tree=True)
+            if keep_raw:
+                buffer = line + "\n"
+            pending = [_xmlize(line, tags)]
+            # the text fed so far, in case it fails to parse and needs to be
+            # dumped for inspection
+            fed = []
+            continue
         # if the buffer already contains something or if the current line
         # starts with the given structure name, then we're inside a target
         # structure that we want to collect; otherwise, just skip to the next
@@ -306,7 +491,11 @@ def iterstruct(vert_file, struct=None, structs=None):
             structs.add(line)
             buffer += line + "\n"
             if end.fullmatch(line):
-                yield Structure(buffer, structs.resolve())
+                structure = Structure(buffer, structs.resolve())
+                structure.context = tuple(stack)
+                if incremental:
+                    tags = _tags(structure.structs)
+                yield structure
                 # NOTE: it might be a good idea to reset structs to a new
                 # ValidTags object at this point, if we truly want to allow for
                 # the possibility that different structures in the same
@@ -0,0 +1,390 @@
+import array
+import base64
+import collections
+import hashlib
+import math
+import random
+from ._pyvert import START_TAG, END_TAG, ATTR
+from ._compiled import ABSENT
+
+
+def _hash64(value):
+    """A 64-bit hash of a string which, unlike ``hash()``, is stable across
+    processes, so that sketches computed on different shards can be merged.
+
+    """
+    value = value.encode("utf-8", errors="surrogatepass")
+    return int.from_bytes(hashlib.blake2b(value, digest_size=8).digest(),
+                          "little")
+
+
+class HyperLogLog:
+    """Estimate the number of distinct strings in a stream in bounded memory.
+
+    Memory use is ``2 ** precision`` bytes and the standard error of the
+    estimate is roughly ``1.04 / sqrt(2 ** precision)``.
+
+    """
+    def __init__(self, precision=14, registers=None):
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = bytearray(registers or self.m)
+        if len(self.registers) != self.m:
+            raise RuntimeError("HyperLogLog registers don't match precision.")
+        self._width = 64 - precision
+        self._mask = (1 << self._width) - 1
+
+    def add(self, value):
+        h = _hash64(value)
+        idx = h >> self._width
+        rank = self._width - (h & self._mask).bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise RuntimeError("Can't merge HyperLogLogs with different "
+                               "precisions.")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self):
+        m = self.m
+        if m >= 128:
+            alpha = 0.7213 / (1 + 1.079 / m)
+        else:
+            alpha = {16: 0.673, 32: 0.697, 64: 0.709}.get(m, 0.7213)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        # small range correction (linear counting)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def to_dict(self):
+        return dict(precision=self.precision,
+                    registers=base64.b64encode(self.registers).decode("ascii"))
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d["precision"], base64.b64decode(d["registers"]))
+
+
+class MisraGries:
+    """Find the most frequent strings in a stream in bounded memory.
+
+    At most ``2 * k`` counters are kept. Whenever they overflow, the smallest
+    counts are subtracted away (Misra-Gries summary), so counts are
+    underestimated by at most ``error``. Summaries are mergeable: merging two
+    summaries of ``k`` counters gives the same guarantees as a summary of the
+    concatenated streams.
+
+    """
+    def __init__(self, k=100, counts=None, error=0):
+        self.k = k
+        self.counts = dict(counts or {})
+        self.error = error
+
+    def add(self, value, count=1):
+        counts = self.counts
+        counts[value] = counts.get(value, 0) + count
+        if len(counts) > 2 * self.k:
+            self._compact()
+
+    def merge(self, other):
+        for value, count in other.counts.items():
+            self.counts[value] = self.counts.get(value, 0) + count
+        self.error += other.error
+        if len(self.counts) > 2 * self.k:
+            self._compact()
+
+    def top(self, n=None):
+        top = sorted(self.counts.items(), key=lambda vc: (-vc[1], vc[0]))
+        return top[:self.k if n is None else n]
+
+    def _compact(self):
+        # subtract the (k+1)-th largest count from all counters and drop
+        # those which don't stay positive
+        threshold = sorted(self.counts.values(), reverse=True)[self.k]
+        self.counts = {v: c - threshold for v, c in self.counts.items()
+                       if c > threshold}
+        self.error += threshold
+
+    def to_dict(self):
+        return dict(k=self.k, error=self.error, counts=self.top(2 * self.k))
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d["k"], ((v, c) for v, c in d["counts"]), d["error"])
+
+
+class Summary:
+    """Distinct count and most frequent values of a stream of strings.
+
+    """
+    def __init__(self, k=100, precision=14):
+        self.hll = HyperLogLog(precision)
+        self.mg = MisraGries(k)
+        self.total = 0
+
+    def add(self, value, count=1):
+        self.hll.add(value)
+        self.mg.add(value, count)
+        self.total += count
+
+    def merge(self, other):
+        self.hll.merge(other.hll)
+        self.mg.merge(other.mg)
+        self.total += other.total
+
+    def to_dict(self):
+        return dict(total=self.total, distinct=self.hll.count(),
+                    top=self.mg.top(), hll=self.hll.to_dict(),
+                    misra_gries=self.mg.to_dict())
+
+    @classmethod
+    def from_dict(cls, d):
+        summary = cls()
+        summary.hll = HyperLogLog.from_dict(d["hll"])
+        summary.mg = MisraGries.from_dict(d["misra_gries"])
+        summary.total = d["total"]
+        return summary
+
+
+class CorpusStats:
+    """Statistics about a vertical gathered in one streaming pass.
+
+    Structure counts, the number of positions and length distributions are
+    exact; the number of distinct values and the most frequent values of
+    structure attributes and positional attributes are estimated with
+    bounded-memory sketches. Statistics computed on different parts of a
+    corpus can be combined with ``merge()``.
+
+    """
+    start = START_TAG
+    end = END_TAG
+    attr = ATTR
+
+    def __init__(self, columns=(0, 1), k=100, precision=14):
+        self.columns = tuple(columns)
+        self.k = k
+        self.precision = precision
+        self.structures = {}
+        self.positions = 0
+        self.lengths = {}
+        self.attributes = {}
+        self.column_stats = {c: Summary(k, precision) for c in self.columns}
+        # names of open structures and the position count when they started
+        self._open = []
+
+    def _summary(self, key):
+        summary = self.attributes.get(key)
+        if summary is None:
+            summary = self.attributes[key] = Summary(self.k, self.precision)
+        return summary
+
+    def update(self, line):
+        """Add a line of the vertical to the statistics.
+
+        """
+        line = line.strip()
+        if not line:
+            return
+        if line[0] == "<" and line[-1] == ">":
+            e = self.end.fullmatch(line)
+            if e:
+                name = e.group(1)
+                # tolerate stray end tags, structures may have been cut
+                for i in range(len(self._open) - 1, -1, -1):
+                    if self._open[i][0] == name:
+                        length = self.positions - self._open[i][1]
+                        hist = self.lengths.setdefault(name, {})
+                        hist[length] = hist.get(length, 0) + 1
+                        del self._open[i]
+                        break
+                return
+            s = self.start.fullmatch(line)
+            if s:
+                name = s.group(1)
+                self.structures[name] = self.structures.get(name, 0) + 1
+                for key, val in self.attr.findall(s.group(2)):
+                    self._summary(name + "@" + key).add(val)
+                if not s.group(3):
+                    self._open.append((name, self.positions))
+            # other markup (comments, declarations) isn't a position either
+            return
+        self.positions += 1
+        if self.column_stats:
+            cols = line.split("\t")
+            for c, summary in self.column_stats.items():
+                if c < len(cols):
+                    summary.add(cols[c])
+
+    def update_compiled(self, corpus):
+        """Add a compiled corpus to the statistics.
+
+        This is much faster than adding its lines one by one: values of
+        positional attributes are counted as ids and each distinct value is
+        only added to the sketches once.
+
+        """
+        self.positions += corpus.positions
+        for name in corpus.structs:
+            hist = self.lengths.setdefault(name, {})
+            n = 0
+            for start, end, start_idx, end_idx in corpus.records(name):
+                n += 1
+                start_tag = START_TAG.fullmatch(corpus.markup[start_idx].strip())
+                for key, val in self.attr.findall(start_tag.group(2)):
+                    self._summary(name + "@" + key).add(val)
+                # void elements have no length
+                if start_idx != end_idx:
+                    hist[end - start] = hist.get(end - start, 0) + 1
+            self.structures[name] = self.structures.get(name, 0) + n
+            if not hist:
+                del self.lengths[name]
+        for c, summary in self.column_stats.items():
+            if c >= len(corpus.ids):
+                continue
+            lexicon = corpus.lexicons[c]
+            counts = collections.Counter(corpus.ids[c])
+            counts.pop(ABSENT, None)
+            for id, count in counts.items():
+                summary.add(lexicon[id], count)
+
+    def merge(self, other):
+        for name, count in other.structures.items():
+            self.structures[name] = self.structures.get(name, 0) + count
+        self.positions += other.positions
+        for name, hist in other.lengths.items():
+            mine = self.lengths.setdefault(name, {})
+            for length, count in hist.items():
+                mine[length] = mine.get(length, 0) + count
+        for key, summary in other.attributes.items():
+            if key in self.attributes:
+                self.attributes[key].merge(summary)
+            else:
+                self.attributes[key] = summary
+        for c, summary in other.column_stats.items():
+            if c in self.column_stats:
+                self.column_stats[c].merge(summary)
+            else:
+                self.column_stats[c] = summary
+
+    def to_dict(self):
+        lengths = {}
+        for name, hist in sorted(self.lengths.items()):
+            n = sum(hist.values())
+            total = sum(length * count for length, count in hist.items())
+            lengths[name] = dict(
+                min=min(hist), max=max(hist), mean=total / n,
+                histogram={str(length): hist[length] for length in sorted(hist)})
+        return dict(
+            structures=dict(sorted(self.structures.items())),
+            positions=self.positions,
+            lengths=lengths,
+            attributes={k: v.to_dict() for k, v in
+                        sorted(self.attributes.items())},
+            columns={str(c): v.to_dict() for c, v in
+                     sorted(self.column_stats.items())})
+
+    @classmethod
+    def from_dict(cls, d):
+        columns = [int(c) for c in d["columns"]]
+        stats = cls(columns=())
+        stats.columns = tuple(columns)
+        stats.structures = dict(d["structures"])
+        stats.positions = d["positions"]
+        stats.lengths = {
+            name: {int(length): count
+                   for length, count in hist["histogram"].items()}
+            for name, hist in d["lengths"].items()}
+        stats.attributes = {k: Summary.from_dict(v)
+                            for k, v in d["attributes"].items()}
+        stats.column_stats = {int(c): Summary.from_dict(v)
+                              for c, v in d["columns"].items()}
+        return stats
+
+
+MERSENNE61 = (1 << 61) - 1
+
+
+class MinHash:
+    """Compute MinHash signatures of sets of shingles and cut them into bands
+    for locality-sensitive hashing.
+
+    Two documents whose shingle sets have Jaccard similarity ``s`` share at
+    least one band with probability ``1 - (1 - s ** rows) ** bands``.
+
+    """
+    def __init__(self, bands=16, rows=8, seed=1):
+        self.bands = bands
+        self.rows = rows
+        rng = random.Random(seed)
+        self.perms = [(rng.randrange(1, MERSENNE61), rng.randrange(MERSENNE61))
+                      for _ in range(bands * rows)]
+
+    def signature(self, shingles):
+        hashes = [_hash64(s) for s in set(shingles)]
+        if not hashes:
+            return None
+        return [min((a * h + b) % MERSENNE61 for h in hashes)
+                for a, b in self.perms]
+
+    def band_keys(self, shingles):
+        """The 64-bit hashes of the bands of the signature of ``shingles``, or
+        an empty list if there are no shingles.
+
+        """
+        sig = self.signature(shingles)
+        if sig is None:
+            return []
+        keys = []
+        for band in range(self.bands):
+            rows = sig[band * self.rows:(band + 1) * self.rows]
+            data = band.to_bytes(2, "little") + b"".join(
+                r.to_bytes(8, "little") for r in rows)
+            keys.append(int.from_bytes(
+                hashlib.blake2b(data, digest_size=8).digest(), "little"))
+        return keys
+
+
+class LSHIndex:
+    """A fixed-size hash table mapping LSH band keys to cluster ids.
+
+    Each slot takes 8 bytes (a 32-bit fingerprint of the key and a 32-bit
+    cluster id), so memory use doesn't grow with the number of documents.
+    When all the slots a key can go to are taken, one of them is overwritten,
+    which only costs some recall on very large inputs.
+
+    """
+    PROBES = 4
+
+    def __init__(self, size=2 ** 24):
+        self.size = size
+        self.slots = array.array("Q", bytes(8 * size))
+
+    def _probe(self, key):
+        fingerprint = (key >> 32) or 1
+        start = key % self.size
+        return fingerprint, [(start + i) % self.size
+                             for i in range(self.PROBES)]
+
+    def get(self, key):
+        fingerprint, probe = self._probe(key)
+        for idx in probe:
+            entry = self.slots[idx]
+            if entry >> 32 == fingerprint:
+                return entry & 0xFFFFFFFF
+            if not entry:
+                return None
+        return None
+
+    def add(self, key, cluster):
+        fingerprint, probe = self._probe(key)
+        entry = fingerprint << 32 | cluster & 0xFFFFFFFF
+        for idx in probe:
+            current = self.slots[idx]
+            if not current or current >> 32 == fingerprint:
+                self.slots[idx] = entry
+                return
+        self.slots[probe[0]] = entry
@@ -0,0 +1,203 @@
+import re
+
+from ._pyvert import START_TAG, END_TAG, ATTR
+
+# what may follow the name in a well-formed start tag
+ATTRS = re.compile(r'(?:\s+\w+="[^"<]*")*\s*')
+# size of the blocks the input is read in
+BLOCK = 2 ** 20
+
+
+class Validator:
+    """Check the well-formedness of a vertical fed to it line by line.
+
+    Problems are collected in ``problems`` as (byte offset, line number,
+    message) tuples. An end tag closes the innermost open structure of the
+    same name, and structures opened after that one are reported as unclosed.
+    Positions are expected to have ``columns`` positional attributes (by
+    default, as many as the first one). If ``structs`` are given, only tags of
+    these names are considered to be structures.
+
+    A validator of a shard of a vertical (``final=False``) can't know whether
+    an end tag which doesn't match anything in the shard closes a structure
+    opened in an earlier shard, so it keeps such end tags (and the structures
+    opened before them) in ``unresolved``, for a final validator to replay
+    them in ``merge()``.
+
+    """
+    def __init__(self, encoding="utf-8", columns=None, structs=None,
+                 final=True, offset=0):
+        self.encoding = encoding
+        self.columns = columns
+        self.structs = structs
+        self.final = final
+        self.offset = offset
+        self.line = 0
+        # open structures as (name, offset, line)
+        self.stack = []
+        # ("open" or "close", name, offset, line), in order
+        self.unresolved = []
+        self.problems = []
+        self._suspects = None
+
+    def check(self, fh, end=None):
+        """Check the lines read from binary file ``fh`` which start before
+        byte offset ``end``.
+
+        """
+        while end is None or self.offset < end:
+            data = fh.read(BLOCK if end is None
+                           else min(BLOCK, end - self.offset))
+            if not data:
+                break
+            if not data.endswith(b"\n"):
+                data += fh.readline()
+            self.feed_block(data)
+        return self
+
+    def feed(self, lines):
+        """Check the next ``lines``, given as bytes.
+
+        """
+        for raw in lines:
+            self.line += 1
+            try:
+                text = raw.decode(self.encoding)
+            except UnicodeDecodeError as e:
+                self.problems.append((self.offset + e.start, self.line,
+                                      "invalid {} byte sequence".format(
+                                          self.encoding)))
+                text = raw.decode(self.encoding, "replace")
+            self._check(text, self.offset)
+            self.offset += len(raw)
+
+    def feed_block(self, data):
+        """Check the next block of whole lines, given as bytes.
+
+        Only lines which might be tags or have an unexpected number of
+        positional attributes are looked at closer, which is several times
+        faster than checking the lines one by one.
+
+        """
+        try:
+            data.decode(self.encoding)
+        except UnicodeDecodeError:
+            # invalid bytes have to be found line by line
+            return self.feed(data.splitlines(keepends=True))
+        if self.columns is None:
+            # and so does the first position, to know how many columns to
+            # expect
+            return self.feed(data.splitlines(keepends=True))
+        lines = data.split(b"\n")
+        if not lines[-1]:
+            lines.pop()
+        tabs = self.columns - 1
+        if tabs:
+            suspects = [i for i, l in enumerate(lines)
+                        if l[:1] == b"<" or l.count(b"\t") != tabs]
+        else:
+            suspects = [i for i, l in enumerate(lines)
+                        if l.lstrip()[:1] == b"<" or b"\t" in l]
+        line, offset, prev = self.line, self.offset, 0
+        for i in suspects:
+            offset += sum(map(len, lines[prev:i])) + i - prev
+            prev = i
+            self.line = line + i + 1
+            self._check(lines[i].decode(self.encoding), offset)
+        self.offset += len(data)
+        self.line = line + len(lines)
+
+    def _check(self, text, offset):
+        stripped = text.strip()
+        if not stripped:
+            return
+        if stripped[0] == "<" and stripped[-1] == ">" \
+                and self._tag(stripped, offset):
+            return
+        columns = text.count("\t") + 1
+        if self.columns is None:
+            self.columns = columns
+        elif columns != self.columns:
+            self.problems.append((offset, self.line, "expected {} columns, "
+                                  "found {}".format(self.columns, columns)))
+
+    def _tag(self, tag, offset):
+        # comments, declarations etc. aren't structures
+        if tag[1] in "!?":
+            return True
+        e = END_TAG.fullmatch(tag)
+        if e:
+            if self.structs and e.group(1) not in self.structs:
+                return False
+            self.close(e.group(1), offset, self.line)
+            return True
+        s = START_TAG.fullmatch(tag)
+        if not s or self.structs and s.group(1) not in self.structs:
+            return False
+        name, attrs, void = s.groups()
+        if not ATTRS.fullmatch(attrs):
+            self.problems.append((offset, self.line,
+                                  "malformed attributes in <{}>".format(name)))
+        else:
+            keys = [key for key, _ in ATTR.findall(attrs)]
+            if len(set(keys)) != len(keys):
+                self.problems.append((offset, self.line, "duplicate "
+                                      "attributes in <{}>".format(name)))
+        if not void:
+            self.stack.append((name, offset, self.line))
+        return True
+
+    def close(self, name, offset, line):
+        for i in range(len(self.stack) - 1, -1, -1):
+            if self.stack[i][0] == name:
+                for inner, o, l in self.stack[i + 1:]:
+                    self.problems.append((o, l, "<{}> not closed before "
+                                          "</{}>".format(inner, name)))
+                del self.stack[i:]
+                return
+        if self.final:
+            self.problems.append((offset, line, "stray </{}>".format(name)))
+        else:
+            self.unresolved.extend(("open",) + s for s in self.stack)
+            self.unresolved.append(("close", name, offset, line))
+            self.stack = []
+
+    def merge(self, shard):
+        """Take over the results of the validator of the next shard.
+
+        """
+        shift = self.line
+        self.problems.extend((o, l + shift, m) for o, l, m in shard.problems)
+        for kind, name, offset, line in shard.unresolved:
+            if kind == "open":
+                self.stack.append((name, offset, line + shift))
+            else:
+                self.close(name, offset, line + shift)
+        self.line += shard.line
+        self.offset = shard.offset
+
+    def finish(self):
+        if self.final:
+            for name, offset, line in self.stack:
+                self.problems.append((offset, line,
+                                      "<{}> not closed".format(name)))
+        else:
+            self.unresolved.extend(("open",) + s for s in self.stack)
+        self.stack = []
+        return self
+
+
+def validate_range(path, start, end, encoding="utf-8", columns=None,
+                   structs=None):
+    """Validate the lines of ``path`` which start between byte offsets
+    ``start`` and ``end``, as a shard of the whole file.
+
+    """
+    with open(path, "rb") as fh:
+        if start > 0:
+            # skip to the start of the first line beginning in the range
+            fh.seek(start - 1)
+            start += len(fh.readline()) - 1
+        validator = Validator(encoding, columns, structs, final=False,
+                              offset=start)
+        return validator.check(fh, end).finish()
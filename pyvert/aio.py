@@ -0,0 +1,165 @@
+"""Asyncio counterparts of ``pyvert.iterstruct()`` and the ``vrt`` commands,
+for verticals read from sockets, pipes and other async byte streams.
+
+Streams are read and split into structures on the event loop; anything
+CPU-heavy (parsing structures into trees, running commands) is done in an
+executor, so that many streams can be processed concurrently without
+blocking the loop.
+
+"""
+import codecs
+import asyncio
+
+from . import _pyvert
+from ._pyvert import Structure, ValidTags, DummyValidTags
+
+__all__ = ["iterlines", "iterstruct", "command"]
+
+
+async def iterlines(reader, encoding="utf-8", errors="strict", size=2 ** 16):
+    """Yield lists of the lines read from ``reader``, an object with a
+    coroutine ``read(n)`` method returning bytes (e.g. an
+    ``asyncio.StreamReader``), as they arrive.
+
+    Lines are yielded in batches, which is much faster than one by one.
+
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors)
+    pending = ""
+    while True:
+        data = await reader.read(size)
+        lines = (pending + decoder.decode(data, final=not data)).split("\n")
+        pending = lines.pop()
+        if lines:
+            yield [line + "\n" for line in lines]
+        if not data:
+            if pending:
+                yield [pending]
+            return
+
+
+async def iterstruct(reader, struct=None, structs=None, encoding="utf-8",
+                     errors="strict", parse=False, executor=None):
+    """Like ``pyvert.iterstruct()``, but over ``reader`` (see
+    ``iterlines()``), yielding each structure as soon as its end tag arrives.
+
+    If ``parse`` is true, the ``.xml`` of each structure is built in
+    ``executor`` (the default one of the loop if None) before it's yielded.
+
+    """
+    if structs is None:
+        structs = _pyvert.STRUCTS
+    lines = iterlines(reader, encoding, errors)
+    if struct is None:
+        struct = "root"
+        lines = _wrap(lines)
+    loop = asyncio.get_running_loop()
+    buffer = ""
+    structs = DummyValidTags(structs) if structs else ValidTags()
+    start = _pyvert.re.compile(r"<{}.*?>".format(struct))
+    end = _pyvert.re.compile(r"</{}>".format(struct))
+    async for batch in lines:
+        for line in batch:
+            line = line.strip()
+            if buffer or start.fullmatch(line):
+                structs.add(line)
+                buffer += line + "\n"
+                if end.fullmatch(line):
+                    structure = Structure(buffer, structs.resolve())
+                    buffer = ""
+                    if parse:
+                        await loop.run_in_executor(
+                            executor, getattr, structure, "xml")
+                    yield structure
+
+
+async def _wrap(lines):
+    yield ["<root>\n"]
+    async for batch in lines:
+        yield batch
+    yield ["</root>\n"]
+
+
+class _Failure:
+    """An exception raised by a command in a worker thread, to be re-raised
+    in the event loop.
+
+    """
+    def __init__(self, error):
+        self.error = error
+
+
+async def command(name, reader, encoding="utf-8", errors="strict",
+                  executor=None, queue=64, **kwargs):
+    """Run the ``vrt`` command ``name`` with ``kwargs`` (as in the
+    ``pyvert.vrt`` API) on the vertical read from ``reader`` (see
+    ``iterlines()``), yielding its output as it's produced.
+
+    The command runs in a thread of ``executor`` (the default one of the
+    loop if None) for as long as the stream lasts, so the executor needs as
+    many threads as there are concurrent streams; the thread is fed batches
+    of lines from the loop. At most
+    ``queue`` batches of input and chunks of output are buffered, so a slow
+    consumer slows down reading. If the command fails, its exception is
+    raised here.
+
+    """
+    from . import vrt
+    gen_func = vrt.API[name]
+    loop = asyncio.get_running_loop()
+    inbox, outbox = asyncio.Queue(queue), asyncio.Queue(queue)
+    done = object()
+    closed = False
+
+    def call(coro):
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+    def vertical():
+        while True:
+            batch = call(inbox.get())
+            if batch is None:
+                return
+            yield from batch
+
+    def work():
+        try:
+            for chunk in gen_func(vertical(), **kwargs):
+                if closed:
+                    return
+                call(outbox.put(chunk))
+        except Exception as e:
+            if not closed:
+                call(outbox.put(_Failure(e)))
+            return
+        if not closed:
+            call(outbox.put(done))
+
+    async def feed():
+        try:
+            async for batch in iterlines(reader, encoding, errors):
+                await inbox.put(batch)
+        except Exception as e:
+            await outbox.put(_Failure(e))
+        finally:
+            await inbox.put(None)
+
+    worker = loop.run_in_executor(executor, work)
+    feeder = asyncio.ensure_future(feed())
+    try:
+        while True:
+            item = await outbox.get()
+            if item is done:
+                break
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        # make sure the worker isn't left waiting for input or for room for
+        # its output if it hasn't finished
+        closed = True
+        feeder.cancel()
+        for q in (inbox, outbox):
+            while not q.empty():
+                q.get_nowait()
+        inbox.put_nowait(None)
+        await worker
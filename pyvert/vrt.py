@@ -1,14 +1,43 @@
 import os
 import io
+import zlib
+import json
+import shlex
+import fnmatch
+import queue
+import threading
+import sys
+import heapq
+import pickle
+import hashlib
+import operator
+import tempfile
+import itertools
+import collections
 import click
 import functools
 import logging
 
-import regex as re
 import random
 import pyvert
 import html
-from lxml import etree
+from ._lazy import LazyModule
+from ._pyvert import START_TAG, END_TAG, ATTR, _projected_key
+from ._stats import CorpusStats, MinHash, LSHIndex
+from ._checkpoint import Checkpoint, CountingReader, DummyCheckpoint
+from ._cache import StructCache, DummyCache
+from ._follow import FollowReader
+from ._compiled import Corpus, compile_vertical, is_compiled
+from ._validate import Validator, validate_range
+from ._metadata import load_table
+
+# these are slow to import and not needed by all commands
+re = LazyModule("regex")
+etree = LazyModule("lxml.etree")
+multiprocessing = LazyModule("multiprocessing")
+futures = LazyModule("concurrent.futures")
+COMPRESSORS = {".gz": LazyModule("gzip"), ".bz2": LazyModule("bz2"),
+               ".xz": LazyModule("lzma")}
 
 # prevent chatty BrokenPipe errors
 from signal import signal, SIGPIPE, SIG_DFL
@@ -62,17 +91,363 @@ def _genfunc2comm(gen_func):
     @functools.wraps(gen_func)
     def command(cx, **kwargs):
         _log_invocation(cx)
+        if cx.obj["output_dir"] is not None:
+            _run_batch(cx, kwargs)
+            return
         logger = logging.getLogger()
-        for i, chunk in enumerate(gen_func(cx.obj["input"], **kwargs)):
-            if logger.getEffectiveLevel() <= logging.INFO:
-                click.echo("\rOutputting vertical fragment #{}.".format(i),
-                           err=True, nl=False)
-            click.echo(chunk.encode(cx.obj["outenc"], errors=cx.obj["errors"]),
-                       nl=False)
+        output, checkpoint = _open_output(cx)
+        write = output.write if checkpoint is None else checkpoint.write
+        try:
+            for i, chunk in enumerate(gen_func(cx.obj["input"], **kwargs)):
+                if logger.getEffectiveLevel() <= logging.INFO:
+                    click.echo("\rOutputting vertical fragment #{}.".format(i),
+                               err=True, nl=False)
+                write(chunk.encode(cx.obj["outenc"], errors=cx.obj["errors"]))
+                if cx.obj["follow"]:
+                    output.flush()
+            if checkpoint is not None:
+                checkpoint.finish()
+        finally:
+            if cx.obj["output"] == "-":
+                output.flush()
+            else:
+                output.close()
 
     return command
 
 
+# commands which record their progress with Checkpoint.mark()
+CHECKPOINT_COMMANDS = {"chunk", "filter", "identify", "tag", "wrap"}
+
+
+def _open_output(cx):
+    """Open the output of the current command and, if checkpointing was
+    requested, set up the checkpoint, resuming from it if it was saved by an
+    earlier, interrupted run. In follow mode, replace the input with a reader
+    which waits for more data at EOF.
+
+    Return the output and the checkpoint (or None).
+
+    """
+    output, path, follow = (cx.obj["output"], cx.obj["checkpoint"],
+                            cx.obj["follow"])
+    input = cx.obj["input"]
+    if (path is not None or follow) and isinstance(input, Corpus):
+        raise RuntimeError("Checkpointing and following aren't supported for "
+                           "compiled corpora.")
+    if (path is not None or follow) and input.name == "-":
+        raise RuntimeError("Checkpointing and following require the input to "
+                           "be a regular file.")
+    if path is not None and cx.command.name not in CHECKPOINT_COMMANDS:
+        raise RuntimeError("Checkpointing isn't supported by {}, only by {}."
+                           .format(cx.command.name,
+                                   ", ".join(sorted(CHECKPOINT_COMMANDS))))
+    if path is not None and output == "-":
+        raise RuntimeError("Checkpointing requires the output to be a regular "
+                           "file.")
+    saved = Checkpoint.load(path) if path is not None else None
+    if path is not None or follow:
+        buffer = open(input.name, "rb")
+        if saved is not None:
+            buffer.seek(saved["offset"])
+        if follow:
+            reader = FollowReader(
+                input.name, buffer, cx.obj["inenc"], cx.obj["errors"],
+                interval=cx.obj["follow_interval"],
+                timeout=cx.obj["follow_timeout"])
+        else:
+            reader = CountingReader(buffer, cx.obj["inenc"], cx.obj["errors"])
+        cx.obj["input"] = reader
+    if path is None:
+        if output == "-":
+            return sys.stdout.buffer, None
+        return open(output, "wb"), None
+    # what the checkpoint is valid for, normalized to what it looks like
+    # after a round trip through JSON; the encodings and error handling
+    # determine both the offsets in the input and the bytes in the output
+    key = json.loads(json.dumps(dict(
+        command=cx.command.name, params=cx.params,
+        input=os.path.abspath(input.name), inenc=cx.obj["inenc"],
+        errors=cx.obj["errors"], outenc=cx.obj["outenc"]), default=str))
+    if saved is None:
+        out = open(output, "wb")
+    else:
+        try:
+            out = open(output, "r+b")
+        except FileNotFoundError as e:
+            raise RuntimeError("Can't resume from checkpoint {}, output {} is "
+                               "missing.".format(path, output)) from e
+    checkpoint = Checkpoint(path, reader, out, cx.obj["checkpoint_every"], key)
+    if saved is not None:
+        checkpoint.resume(saved)
+        # drop whatever was written after the checkpoint was saved
+        out.truncate(saved["written"])
+        out.seek(saved["written"])
+        logging.info("Resuming from checkpoint {} at input byte {}.".format(
+            path, saved["offset"]), extra=dict(command=cx.command.name))
+    if follow:
+        # don't let the checkpoint lag behind while waiting for input
+        reader.idle = checkpoint.save
+    cx.meta["pyvert.checkpoint"] = checkpoint
+    return out, checkpoint
+
+
+MANIFEST = ".vrt-manifest.json"
+
+
+def _batch_inputs(inputs, pattern):
+    """Yield pairs of input files and their paths relative to the output
+    directory, looking for files matching ``pattern`` in directories.
+
+    """
+    for path in inputs:
+        if not os.path.isdir(path):
+            yield path, os.path.basename(path)
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for fn in sorted(fnmatch.filter(files, pattern)):
+                full = os.path.join(root, fn)
+                yield full, os.path.relpath(full, path)
+
+
+def _batch_file(command, kwargs, settings, path, out_path):
+    """Run ``command`` on one input file of a batch.
+
+    The output is written to a temporary file which is renamed to
+    ``out_path`` once it's complete. The command runs in a click context of
+    its own, so that it picks up global settings like ``--cache``.
+
+    """
+    os.makedirs(os.path.dirname(out_path) or ".", exist_ok=True)
+    tmp = out_path + ".tmp"
+    cx = click.Context(vrt.commands[command], obj=dict(settings))
+    kwargs = _reopen_files(cx, kwargs)
+    with cx, open(path, encoding=settings["inenc"],
+                  errors=settings["errors"]) as vertical, \
+            open(tmp, "wb") as out:
+        for chunk in API[command](vertical, **kwargs):
+            out.write(chunk.encode(settings["outenc"],
+                                   errors=settings["errors"]))
+    os.replace(tmp, out_path)
+
+
+def _file_params(command):
+    """Return the parameters of ``command`` which are opened as files.
+
+    """
+    return {p.name: p for p in command.params
+            if isinstance(p.type, click.File)}
+
+
+def _reopen_files(cx, kwargs):
+    """Open the files in ``kwargs``, which were replaced by their paths to be
+    sent to another process, in the context ``cx``.
+
+    """
+    kwargs = dict(kwargs)
+    for name, param in _file_params(cx.command).items():
+        value = kwargs.get(name)
+        if value is None:
+            continue
+        if param.multiple:
+            kwargs[name] = [param.type.convert(v, param, cx) for v in value]
+        else:
+            kwargs[name] = param.type.convert(value, param, cx)
+    return kwargs
+
+
+def _batch_worker(args):
+    command, kwargs, settings, path, out_path = args
+    try:
+        _batch_file(command, kwargs, settings, path, out_path)
+    except Exception as e:
+        return path, "{}: {}".format(type(e).__name__, e)
+    return path, None
+
+
+def _run_batch(cx, kwargs):
+    """Run the current command on each of the ``--inputs``, writing the
+    outputs to ``--output-dir``, in a pool of ``--batch-jobs`` processes.
+
+    Inputs whose output is newer than them and was produced by the same
+    command with the same parameters, as recorded in a manifest in the output
+    directory, are skipped.
+
+    """
+    command, obj = cx.command.name, cx.obj
+    if obj["checkpoint"] is not None:
+        raise RuntimeError("Checkpointing isn't supported in batch mode.")
+    if not obj["inputs"]:
+        raise RuntimeError("Batch mode requires --inputs.")
+    if obj["cache"] is not None and obj["batch_jobs"] > 1:
+        raise RuntimeError("A --cache can't be shared by several "
+                           "--batch-jobs.")
+    # open files can't be sent to other processes, their paths are
+    kwargs = dict(kwargs)
+    for name, param in _file_params(cx.command).items():
+        value = kwargs.get(name)
+        if value is None:
+            continue
+        kwargs[name] = [f.name for f in value] if param.multiple \
+            else value.name
+    settings = {k: v for k, v in obj.items()
+                if k in ("inenc", "outenc", "errors", "cache", "cache_size")}
+    params = json.dumps([command, kwargs, settings, pyvert.__version__],
+                        sort_keys=True, default=str)
+    params = hashlib.blake2b(params.encode("utf-8"), digest_size=16).hexdigest()
+    out_dir = obj["output_dir"]
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_path = os.path.join(out_dir, MANIFEST)
+    try:
+        with open(manifest_path, encoding="utf-8") as fh:
+            manifest = json.load(fh)
+    except FileNotFoundError:
+        manifest = {}
+
+    def save_manifest():
+        tmp = manifest_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump(manifest, fh, indent=1, sort_keys=True)
+        os.replace(tmp, manifest_path)
+
+    tasks = {}
+    for path, rel in _batch_inputs(obj["inputs"], obj["pattern"]):
+        out_path = os.path.join(out_dir, rel)
+        try:
+            up_to_date = manifest.get(rel) == params and \
+                os.path.getmtime(out_path) >= os.path.getmtime(path)
+        except OSError:
+            up_to_date = False
+        if up_to_date:
+            logging.info("Skipping up-to-date {}.".format(path),
+                         extra=dict(command=command))
+            continue
+        # the entry will be reinstated once the output is complete
+        manifest.pop(rel, None)
+        tasks[path] = (command, kwargs, settings, path, out_path), rel
+    save_manifest()
+    args = [task for task, _ in tasks.values()]
+    jobs = min(obj["batch_jobs"], len(args))
+    pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+    results = map(_batch_worker, args) if pool is None else \
+        pool.imap_unordered(_batch_worker, args)
+    failures = []
+    try:
+        for i, (path, error) in enumerate(results, start=1):
+            if error is None:
+                manifest[tasks[path][1]] = params
+                save_manifest()
+                logging.info("Processed {} ({}/{}).".format(
+                    path, i, len(args)), extra=dict(command=command))
+            else:
+                failures.append((path, error))
+    finally:
+        if pool is not None:
+            pool.terminate()
+    if failures:
+        raise RuntimeError("Processing failed for: {}".format(
+            "; ".join("{} ({})".format(p, e) for p, e in failures)))
+
+
+def _checkpoint(command):
+    """Return the checkpoint of ``command`` if it's being run from the command
+    line with checkpointing, otherwise a dummy one.
+
+    """
+    cx = click.get_current_context(silent=True)
+    if cx is not None and cx.command.name == command:
+        return cx.meta.get("pyvert.checkpoint", DummyCheckpoint())
+    return DummyCheckpoint()
+
+
+def _cache(command, **params):
+    """Return the cache of ``command`` run with ``params`` if it's being run
+    from the command line with caching, otherwise a dummy one.
+
+    """
+    cx = click.get_current_context(silent=True)
+    if cx is None or cx.command.name != command or not cx.obj.get("cache"):
+        return DummyCache()
+    cache = StructCache.for_command(
+        cx.obj["cache"], command, params, pyvert.__version__,
+        size=cx.obj["cache_size"] * 2 ** 20)
+    cx.call_on_close(cache.close)
+    return cache
+
+
+def _output_encoding(outenc=None, errors=None):
+    """Return ``outenc`` and ``errors`` for writing output files, defaulting
+    to the global options of the same name if run from the command line.
+
+    """
+    cx = click.get_current_context(silent=True)
+    settings = cx.obj if cx is not None and cx.obj else {}
+    if outenc is None:
+        outenc = settings.get("outenc", "utf-8")
+    if errors is None:
+        errors = settings.get("errors", "strict")
+    return outenc, errors
+
+
+def _incremental():
+    """Whether trees should be built incrementally, as requested on the
+    command line.
+
+    """
+    cx = click.get_current_context(silent=True)
+    return cx is not None and bool(cx.obj and cx.obj.get("incremental"))
+
+
+def _threads(command):
+    """Return the number of threads to process the structures of ``command``
+    in, as requested on the command line.
+
+    Checkpoints record how far the input has been read, so with
+    checkpointing, structures are processed one at a time and the input is
+    never read ahead of the output.
+
+    """
+    cx = click.get_current_context(silent=True)
+    if cx is None or not cx.obj or \
+            not isinstance(_checkpoint(command), DummyCheckpoint):
+        return 1
+    return cx.obj.get("threads", 1)
+
+
+def _threaded(func, items, threads, window=None):
+    """Yield ``func(item)`` for each of ``items``, in order.
+
+    If ``threads`` > 1, the calls are made concurrently in a pool of that many
+    threads. This pays off when ``func`` spends most of its time in lxml
+    (parsing, transforming and serializing trees), which releases the GIL
+    while it works. Unlike with a pool of processes, the items don't need to
+    be pickled and copied over.
+
+    At most ``window`` items (by default, twice as many as threads) are in
+    flight at any time, so memory use doesn't depend on how far ahead the
+    input could be read.
+
+    """
+    if threads <= 1:
+        yield from map(func, items)
+        return
+    window = window or 2 * threads
+    pending = collections.deque()
+    with futures.ThreadPoolExecutor(threads) as executor:
+        try:
+            for item in items:
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+                pending.append(executor.submit(func, item))
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # don't bother finishing work whose results won't be needed
+            for future in pending:
+                future.cancel()
+
+
 def linewise(chunks):
     """Iterate over vertical chunks in a linewise fashion.
 
@@ -96,6 +471,34 @@ def linewise(chunks):
             yield from io.StringIO(chunk)
 
 
+def _batched(iterable, size):
+    """Yield lists of (at most) ``size`` consecutive items of ``iterable``.
+
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _set_attr(start_tag, key, val):
+    """Set attribute ``key`` to ``val`` on a structure start tag line, either
+    by replacing the existing value or by appending the attribute.
+
+    """
+    # escape like _xmlize(), so that the tag remains valid XML
+    val = val.replace("&", "&amp;").replace("<", "&lt;") \
+        .replace(">", "&gt;").replace('"', "&quot;")
+    tag, n = re.subn(r'(?<=\s{}=")[^"]*(?=")'.format(re.escape(key)),
+                     lambda _: val, start_tag, count=1)
+    if n:
+        return tag
+    end = -2 if tag.endswith("/>") else -1
+    return '{} {}="{}"{}'.format(tag[:end].rstrip(), key, val, tag[end:])
+
+
 ############
 # Commands #
 ############
@@ -109,11 +512,44 @@ def linewise(chunks):
 @_option("--outenc", type=str, default="utf-8", help="Output encoding.")
 @_option("--errors", default="strict", type=click.Choice(ENC_ERR_HNDLRS),
          help="How to handle encoding errors.")
+@_option("-o", "--output", default="-",
+         type=click.Path(dir_okay=False, allow_dash=True),
+         help="Path to write the output to (- for STDOUT).")
+@_option("--checkpoint", default=None, type=click.Path(dir_okay=False),
+         help="Path to a checkpoint file for resuming interrupted runs.")
+@_option("--checkpoint-every", default=1000, type=click.IntRange(1),
+         help="Number of structures (sentences for tag) between checkpoints.")
+@_option("--cache", default=None, type=click.Path(file_okay=False),
+         help="Directory of a cache of per-structure results.")
+@_option("--cache-size", default=1024, type=click.IntRange(1),
+         help="Maximum size of the cache in MiB.")
+@_option("-I", "--inputs", type=click.Path(exists=True), multiple=True,
+         help="Input files or directories to process in batch mode.")
+@_option("-O", "--output-dir", default=None, type=click.Path(file_okay=False),
+         help="Output directory; enables batch mode.")
+@_option("--pattern", default="*.vrt", type=str,
+         help="Pattern of input file names to look for in directories.")
+@_option("--batch-jobs", default=1, type=click.IntRange(1),
+         help="Number of files to process in parallel in batch mode.")
+@_option("-f", "--follow", default=False, is_flag=True,
+         help="Wait for more input at EOF, like tail -f.")
+@_option("--follow-interval", default=1.0, type=float,
+         help="Seconds between checks for more input in follow mode.")
+@_option("--follow-timeout", default=None, type=float,
+         help="Stop following after this many seconds without new input.")
+@_option("--incremental", default=False, is_flag=True,
+         help="Build trees while reading structures (saves memory).")
+@_option("--threads", default=1, type=click.IntRange(1),
+         help="Number of threads to parse and serialize structures in.")
 @_option("--id", type=str, default="",
          help="Give an ID to this call to distinguish it in the logs.")
 @_option("-l", "--log", help="Logging verbosity.", default="INFO",
          type=click.Choice(["DEBUG", "INFO", "WARNING", "ERROR"]))
-def vrt(cx, input, inenc, outenc, errors, id, log):
+def vrt(cx, input, inenc, outenc, errors, output, checkpoint,
+        checkpoint_every, cache, cache_size, inputs, output_dir, pattern,
+        batch_jobs, follow, follow_interval, follow_timeout, incremental,
+        threads,
+        id, log):
     """Slice and dice a corpus in vertical format.
 
     Available COMMANDs are listed below and are documented with ``vrt COMMAND
@@ -125,12 +561,72 @@ def vrt(cx, input, inenc, outenc, errors, id, log):
     unknown tags might be XML-escaped. If unsure, leave it unset, valid tags
     will be detected automatically, which is somewhat slower but safer.
 
+    The ``--input`` can also be a corpus compiled with ``vrt compile``, which
+    all commands accept and some (e.g. ``filter``, ``stats`` and ``strip``)
+    process without reconstructing the text of the whole vertical.
+
+    Long runs of the ``chunk``, ``filter``, ``identify``, ``tag`` and ``wrap``
+    commands can be made resumable with ``--checkpoint``: every
+    ``--checkpoint-every`` structures, the position in the input and the
+    output and any state of the command are recorded in the checkpoint file.
+    If the run is interrupted, running the same command again picks up where
+    the last checkpoint left off, and the output ends up identical to that of
+    an uninterrupted run. This requires ``--input`` and ``--output`` to be
+    regular files.
+
+    The ``chunk``, ``project`` and ``tag`` commands can keep the results for
+    individual structures (sentences for ``tag``) in a ``--cache``, keyed by
+    a hash of the structure together with the command, its parameters and
+    the version of pyvert. When the command is run again on an updated
+    corpus, only new or changed structures are processed. Least recently used
+    entries are evicted when the cache grows over ``--cache-size``.
+
+    In batch mode, enabled by giving an ``--output-dir``, the command is run
+    on each of the ``--inputs`` (files, or directories searched recursively
+    for files matching ``--pattern``) and the outputs are written to files of
+    the same name in the output directory. Files are processed by a pool of
+    ``--batch-jobs`` processes, each of which keeps state like a loaded tagger
+    between files. Inputs whose output is newer and was produced by the same
+    command with the same parameters (as recorded in a ``.vrt-manifest.json``
+    in the output directory) are skipped.
+
+    With ``--follow``, the input file is expected to keep growing: at EOF,
+    commands wait for more data instead of stopping, and output structures as
+    soon as their end tag arrives. Truncation and rotation of the input file
+    are handled. Combined with ``--checkpoint``, the position in the input is
+    also saved while waiting, so a restarted follower continues where it
+    stopped.
+
+    With ``--incremental``, the ``chunk``, ``group``, ``identify`` and
+    ``project`` commands build the XML tree of each structure line by line as
+    it's read, instead of collecting its text first and parsing it afterwards,
+    which takes several times less memory on large structures.
+
+    With ``--threads``, the same commands parse, transform and serialize
+    several structures at once in a pool of threads, while the output stays
+    in the order of the input. lxml releases the GIL while it works, so this
+    scales with the number of cores without the memory overhead of a pool of
+    processes, each with its own copy of the data. Only a few structures per
+    thread are held in memory at a time. Threads aren't used with
+    ``--checkpoint``, nor by ``chunk`` without ``--cache`` (see its help).
+
     """
     if PYVERT_STRUCTS:
         pyvert.config(structs=PYVERT_STRUCTS)
-    input = click.File("r", encoding=inenc, errors=errors)(input.name, ctx=cx)
+    if input.name != "-" and is_compiled(input.name):
+        input = Corpus(input.name)
+        cx.call_on_close(input.close)
+    else:
+        input = click.File("r", encoding=inenc, errors=errors)(input.name,
+                                                                ctx=cx)
     cx.obj.update(input=input, inenc=inenc, outenc=outenc, errors=errors,
-                  log=log)
+                  output=output, checkpoint=checkpoint,
+                  checkpoint_every=checkpoint_every, cache=cache,
+                  cache_size=cache_size, inputs=inputs, output_dir=output_dir,
+                  pattern=pattern, batch_jobs=batch_jobs, follow=follow,
+                  follow_interval=follow_interval,
+                  follow_timeout=follow_timeout, incremental=incremental,
+                  threads=threads, log=log)
     top_command = cx.command.name + ("({})".format(id) if id else "")
     logging.basicConfig(level=log, format="[%(asctime)s " + top_command +
                         "/%(command)s:%(levelname)s] %(message)s")
@@ -164,14 +660,139 @@ def chunk(vertical, ancestor, child, name="chunk", minmax=(2000, 5000)):
     shorter, or when the next child boundary occurs some positions after the
     maximum limit.
 
+    The chunk lengths are random, but the random number generator is seeded
+    at the start of the run, so the chunking is replicable across runs on the
+    same data. With ``--cache``, the generator is seeded with the content of
+    each ``ancestor`` instead, so that the chunking of a structure doesn't
+    depend on the structures preceding it and can be reused; the chunk
+    lengths then differ from those of a run without a cache. For the same
+    reason, ``--threads`` only apply with ``--cache``.
+
     """
-    # we want the chunking to be randomized within the minmax range, but
-    # replicable across runs on the same data
-    random.seed(1)
-    for i, struct in enumerate(pyvert.iterstruct(vertical, struct=ancestor)):
-        chunkified = struct.chunk(child=child, name=name, minmax=minmax,
-                                  fallback_orig_id="__autoid{}__".format(i))
-        yield etree.tounicode(chunkified)
+    checkpoint = _checkpoint("chunk")
+    cache = _cache("chunk", ancestor=ancestor, child=child, name=name,
+                   minmax=minmax)
+    cached = not isinstance(cache, DummyCache)
+    if cached:
+        rng = None
+    else:
+        # a single generator for the whole run, which has to be drawn from in
+        # the order of the structures
+        rng = random.Random(1)
+        if "random" in checkpoint.state:
+            version, internal, gauss = checkpoint.state["random"]
+            rng.setstate((version, tuple(internal), gauss))
+    # the text is needed for the cache key and for seeding the generator
+    structs = pyvert.iterstruct(vertical, struct=ancestor,
+                                incremental=_incremental(), keep_raw=cached)
+
+    def lookup():
+        for i, struct in enumerate(structs, start=checkpoint.start):
+            fallback_orig_id = "__autoid{}__".format(i)
+            # the fallback id only ends up in the output if there's no @id
+            key = cache.key(struct.raw, "" if "id" in struct.attr
+                            else fallback_orig_id) if cached else None
+            yield i, struct, fallback_orig_id, key, cache.get(key)
+
+    def chunkify(item):
+        i, struct, fallback_orig_id, key, chunkified = item
+        if chunkified is None:
+            # we want the chunking to be randomized within the minmax range,
+            # but replicable across runs on the same data
+            chunkified = etree.tounicode(struct.chunk(
+                child=child, name=name, minmax=minmax,
+                fallback_orig_id=fallback_orig_id,
+                rng=random.Random(struct.raw) if cached else rng))
+            return i, key, chunkified, True
+        return i, key, chunkified, False
+
+    threads = _threads("chunk") if cached else 1
+    for i, key, chunkified, new in _threaded(chunkify, lookup(), threads):
+        if new:
+            cache.put(key, chunkified)
+        yield chunkified
+        if cached:
+            checkpoint.mark(i)
+        else:
+            checkpoint.mark(i, random=rng.getstate())
+
+
+def _group_sorted(vertical, target, attr, parent, unique, as_struct, reverse):
+    """Like ``group()``, but for targets sorted by ``attr``, line by line.
+
+    """
+    sort_key = _sort_key(attr)
+    attr = [a.partition(":")[0] for a in attr]
+    # the whole vertical is the parent if none is given
+    inside = parent is None
+    parent_attr = {}
+    parents = 0
+    # key and sort key of the open group, if any
+    key = last = None
+    # > 0 inside a target, 0 after one (its tail goes to the same group)
+    depth = None
+
+    def open_group(attrs):
+        root_id = parent_attr.get("id", "__autoid{}__".format(parents))
+        id = ",".join(str(attrs.get(a)) for a in attr)
+        if not unique:
+            id = root_id + "/" + id
+        attrib = dict(parent_attr)
+        attrib.update(attrs)
+        attrib["id"] = id
+        return "<{}{}>\n".format(as_struct, "".join(
+            ' {}="{}"'.format(k, v) for k, v in attrib.items()))
+
+    for line in vertical:
+        stripped = line.strip()
+        s = START_TAG.fullmatch(stripped)
+        e = None if s else END_TAG.fullmatch(stripped)
+        if not inside:
+            if s and s.group(1) == parent:
+                inside = True
+                parent_attr = dict(ATTR.findall(s.group(2)))
+                yield stripped + "\n"
+            continue
+        if parent is not None and e and e.group(1) == parent and not depth:
+            if key is not None:
+                yield "</{}>\n".format(as_struct)
+            yield stripped + "\n"
+            inside, key, last, depth = False, None, None, None
+            parents += 1
+            continue
+        if depth:
+            yield stripped + "\n"
+            if s and s.group(1) == target and not s.group(3):
+                depth += 1
+            elif e and e.group(1) == target:
+                depth -= 1
+            continue
+        if s and s.group(1) == target:
+            attrs = dict(ATTR.findall(s.group(2)))
+            new_key = tuple(attrs.get(a) for a in attr)
+            if new_key != key:
+                new_last = sort_key(attrs)
+                if last is not None and (new_last >= last if reverse
+                                         else new_last <= last):
+                    raise RuntimeError(
+                        "Input is not sorted by {}: {} follows {} within "
+                        "the same parent. Sort it first, or leave out "
+                        "--sorted.".format(", ".join(attr),
+                                           ",".join(map(str, new_key)),
+                                           ",".join(map(str, key))))
+                if key is not None:
+                    yield "</{}>\n".format(as_struct)
+                yield open_group(attrs)
+                key, last = new_key, new_last
+            yield stripped + "\n"
+            depth = 0 if s.group(3) else 1
+        elif s or e:
+            # other structures end the tail of the preceding target
+            depth = None
+        elif depth == 0:
+            yield stripped + "\n"
+    if key is not None and parent is None:
+        yield "</{}>\n".format(as_struct)
 
 
 @vrt.command()
@@ -186,9 +807,14 @@ def chunk(vertical, ancestor, child, name="chunk", minmax=(2000, 5000)):
          help="Grouping attributes are unique identifiers.")
 @_option("--as", "as_struct", default="group", type=str,
          help="Tag name of the group structures.")
+@_option("--sorted", "presorted", default=False, is_flag=True,
+         help="Input is sorted by the attributes, stream it line by line.")
+@_option("-r", "--reverse", default=False, is_flag=True,
+         help="With --sorted, input is sorted in descending order.")
 @_genfunc2comm
 @_add2api
-def group(vertical, target, attr, parent=None, unique=False, as_struct="group"):
+def group(vertical, target, attr, parent=None, unique=False, as_struct="group",
+          presorted=False, reverse=False):
     """Group structures in vertical according to an attribute.
 
     Group all ``target`` structures within each ``parent`` structure
@@ -202,8 +828,25 @@ def group(vertical, target, attr, parent=None, unique=False, as_struct="group"):
     If no ``parent`` is given, groups will be constructed at the top level of
     the vertical.
 
+    With ``--sorted``, targets within each parent are expected to be sorted by
+    ``attr`` (e.g. by ``vrt sort``), so each group is output as soon as the
+    next one starts, line by line, without building any trees. Like sort
+    keys, each ``attr`` can be suffixed with ``:int`` or ``:float`` to compare
+    values as numbers, and ``--reverse`` indicates descending order. If
+    targets turn out not to be sorted, the command fails instead of
+    outputting a group twice. Lines are output verbatim.
+
     """
-    for i, struct in enumerate(pyvert.iterstruct(vertical, struct=parent)):
+    if presorted:
+        yield from _group_sorted(vertical, target, attr, parent, unique,
+                                 as_struct, reverse)
+        return
+    attr = [a.partition(":")[0] for a in attr]
+    structs = pyvert.iterstruct(vertical, struct=parent,
+                                incremental=_incremental())
+
+    def group_struct(item):
+        i, struct = item
         fri = None if unique else "__autoid{}__".format(i)
         grouped = struct.group(target=target, attr=attr, as_struct=as_struct,
                                fallback_root_id=fri)
@@ -212,7 +855,9 @@ def group(vertical, target, attr, parent=None, unique=False, as_struct="group"):
         # valid XML when it's taken as a whole
         if parent is None:
             serialized = serialized[7:-8]
-        yield serialized
+        return serialized
+
+    yield from _threaded(group_struct, enumerate(structs), _threads("group"))
 
 
 @vrt.command()
@@ -244,13 +889,995 @@ def filter(vertical, struct, attr, match="all"):
         match = "isdisjoint"
     else:
         raise RuntimeError("Unsupported matching strategy: {}.".format(match))
-    for struct in pyvert.iterstruct(vertical, struct=struct):
+    checkpoint = _checkpoint("filter")
+    structs = pyvert.iterstruct(vertical, struct=struct)
+    for i, struct in enumerate(structs, start=checkpoint.start):
         struct_attr = set(struct.attr.items())
         # check if struct_attr is a superset of attr (if match == "all") or
         # whether the intersection of struct_attr and attr is non-zero (if
         # match == "any")
         if getattr(struct_attr, match)(attr):
             yield struct.raw
+        checkpoint.mark(i)
+
+
+@vrt.command()
+@click.pass_context
+@_option("-s", "--struct", default="doc", type=str,
+         help="Structures into which the vertical will be split.")
+@_option("-p", "--pattern", default=[], type=str, multiple=True,
+         help="Word form, lemma etc. to search for.")
+@_option("-f", "--patterns-file", default=None, type=click.File("r"),
+         help="File with additional patterns, one per line.")
+@_option("-c", "--column", default=0, type=int,
+         help="Index of the positional attribute to search (0-based).")
+@_option("-m", "--match", default="any", type=click.Choice(["any", "none"]),
+         help="Keep structures where any / none of the positions match.")
+@_option("-i", "--ignore-case", default=False, is_flag=True,
+         help="Compare patterns and positions case-insensitively.")
+@_genfunc2comm
+@_add2api
+def grep(vertical, struct, pattern=(), patterns_file=None, column=0,
+         match="any", ignore_case=False):
+    """Filter structures in vertical according to their contents.
+
+    All structures above ``struct`` are discarded. The output is a vertical
+    consisting of structures of type struct in which ``any/none`` of the
+    positions have a value in ``column`` that is one of the ``pattern``s
+    (exact match). Additional patterns can be read from ``patterns_file``,
+    which makes it practical to search for whole terminology lists at once.
+
+    """
+    patterns = set(pattern)
+    if patterns_file is not None:
+        patterns.update(p.strip() for p in patterns_file)
+        patterns.discard("")
+    if ignore_case:
+        patterns = {p.casefold() for p in patterns}
+    # a hashed set of exact terms makes the lookup cost independent of the
+    # number of patterns, unlike an alternation of thousands of regexes
+    patterns = frozenset(patterns)
+    if match == "any":
+        keep = True
+    elif match == "none":
+        keep = False
+    else:
+        raise RuntimeError("Unsupported matching strategy: {}.".format(match))
+    for struct in pyvert.iterstruct(vertical, struct=struct):
+        found = False
+        for line in struct.raw.split("\n"):
+            # skip structure tags and empty lines
+            if not line or line[0] == "<" and line[-1] == ">":
+                continue
+            try:
+                value = line.split("\t", column + 1)[column]
+            except IndexError:
+                continue
+            if ignore_case:
+                value = value.casefold()
+            if value in patterns:
+                # the outcome is known, no need to look at the rest
+                found = True
+                break
+        if found is keep:
+            yield struct.raw
+
+
+class _OpenStructs:
+    """Keep track of the attributes of currently open structures while
+    iterating over a vertical line by line.
+
+    """
+    start = START_TAG
+    end = END_TAG
+    attr = ATTR
+
+    def __init__(self, refs=(), stack=None):
+        self.refs = refs
+        self.stack = {k: list(v) for k, v in stack.items()} if stack else {}
+        self.values = self._values()
+
+    def update(self, line):
+        """Register ``line`` if it's a structure tag and return True, otherwise
+        return False.
+
+        """
+        if not line or line[0] != "<" or line[-1] != ">":
+            return False
+        e = self.end.fullmatch(line)
+        s = None if e else self.start.fullmatch(line)
+        if e:
+            opened = self.stack.get(e.group(1))
+            if opened:
+                opened.pop()
+        elif s:
+            # void elements are never open, so they don't change the context
+            if not s.group(3):
+                self.stack.setdefault(s.group(1), []).append(
+                    dict(self.attr.findall(s.group(2))))
+        else:
+            return False
+        self.values = self._values()
+        return True
+
+    def _values(self):
+        values = []
+        for struct, attr in self.refs:
+            opened = self.stack.get(struct)
+            values.append(opened[-1].get(attr, "") if opened else "")
+        return tuple(values)
+
+
+def _parse_cql(query, pattr):
+    """Parse a sequence of CQL-like token constraints.
+
+    The supported subset consists of ``[]`` (any token) and conjunctions of
+    ``attr="regex"`` or ``attr!="regex"`` tests joined by ``&``, e.g.
+    ``[lemma="be"][tag="N.*" & word!="[A-Z].*"]``. Regexes must match the
+    whole value.
+
+    """
+    pattr = {name: i for i, name in enumerate(pattr)}
+    token = re.compile(r"\s*\[\s*")
+    test = re.compile(r'(\w+)\s*(!?=)\s*"((?:[^"\\]|\\.)*)"\s*')
+    conj = re.compile(r"&\s*")
+    close = re.compile(r"\]\s*")
+    constraints = []
+    pos = 0
+    while pos < len(query):
+        m = token.match(query, pos)
+        if not m:
+            raise RuntimeError("Malformed query at position {}: {}".format(
+                pos, query))
+        pos = m.end()
+        tests = []
+        while True:
+            m = close.match(query, pos)
+            if m:
+                pos = m.end()
+                break
+            if tests:
+                m = conj.match(query, pos)
+                if not m:
+                    raise RuntimeError("Malformed query at position {}: {}"
+                                       .format(pos, query))
+                pos = m.end()
+            m = test.match(query, pos)
+            if not m:
+                raise RuntimeError("Malformed query at position {}: {}".format(
+                    pos, query))
+            pos = m.end()
+            name, op, value = m.groups()
+            if name not in pattr:
+                raise RuntimeError(
+                    "Unknown positional attribute in query: {}.".format(name))
+            tests.append((pattr[name], re.compile(value), op == "!="))
+        constraints.append(tests)
+    if not constraints:
+        raise RuntimeError("Empty query.")
+    return constraints
+
+
+def _kwic(vertical, query, context, display, refs, within, stack=None):
+    """Search ``vertical`` line by line for token sequences matching ``query``
+    and yield them as KWIC lines.
+
+    Only a sliding window of ``2 * context + len(query)`` positions is kept in
+    memory. ``stack`` can be used to provide the structures that are already
+    open when ``vertical`` starts (see ``_OpenStructs``).
+
+    """
+    structs = _OpenStructs(refs, stack)
+    qlen = len(query)
+    window = []
+    # index into window of the next position to try as the start of a match
+    nxt = 0
+
+    def matches(i):
+        for j, tests in enumerate(query):
+            cols = window[i + j][0]
+            for col, regex, negate in tests:
+                value = cols[col] if col < len(cols) else ""
+                if bool(regex.fullmatch(value)) is negate:
+                    return False
+        return True
+
+    def kwic(i):
+        def text(tokens):
+            return " ".join(cols[display] if display < len(cols) else ""
+                            for cols, _ in tokens)
+        left = text(window[max(0, i - context):i])
+        kw = text(window[i:i + qlen])
+        right = text(window[i + qlen:i + qlen + context])
+        return "\t".join(window[i][1] + (left, kw, right)) + "\n"
+
+    for line in vertical:
+        line = line.strip()
+        if structs.update(line):
+            if within is not None and line == "</{}>".format(within):
+                # flush the window, matches can't cross ``within`` boundaries
+                while nxt + qlen <= len(window):
+                    if matches(nxt):
+                        yield kwic(nxt)
+                    nxt += 1
+                window, nxt = [], 0
+            continue
+        if not line:
+            continue
+        window.append((line.split("\t"), structs.values))
+        while nxt + qlen + context <= len(window):
+            if matches(nxt):
+                yield kwic(nxt)
+            nxt += 1
+        # drop positions which can no longer be part of any left context
+        if nxt > 2 * context + qlen:
+            del window[:nxt - context]
+            nxt = context
+    while nxt + qlen <= len(window):
+        if matches(nxt):
+            yield kwic(nxt)
+        nxt += 1
+
+
+def _kwic_batch(batch, **kwargs):
+    stack, lines = batch
+    return "".join(_kwic(lines, stack=stack, **kwargs))
+
+
+def _kwic_batches(vertical, within, size=10000):
+    """Chop ``vertical`` into batches of lines at ``within`` boundaries, along
+    with the structures open at the start of each batch.
+
+    """
+    structs = _OpenStructs()
+    stack = {}
+    batch = []
+    end = "</{}>".format(within)
+    for line in vertical:
+        line = line.strip()
+        batch.append(line)
+        structs.update(line)
+        if line == end and len(batch) >= size:
+            yield stack, batch
+            stack = {k: list(v) for k, v in structs.stack.items()}
+            batch = []
+    if batch:
+        yield stack, batch
+
+
+@vrt.command()
+@click.pass_context
+@_option("-q", "--query", required=True, type=str,
+         help='CQL-like query, e.g. \'[lemma="x"][tag="N.*"]\'.')
+@_option("-P", "--pattr", default=["word", "lemma", "tag"], type=str,
+         multiple=True, help="Names of the positional attributes, in order.")
+@_option("-c", "--context", default=5, type=int,
+         help="Number of positions of left and right context.")
+@_option("-d", "--display", default="word", type=str,
+         help="Positional attribute to display in the concordance.")
+@_option("-r", "--ref", default=[], type=str, multiple=True,
+         help="Structure attribute(s) to output as references, e.g. doc@id.")
+@_option("-w", "--within", default=None, type=str,
+         help="Structure whose boundaries matches and contexts can't cross.")
+@_option("-j", "--jobs", default=1, type=int,
+         help="Number of worker processes (requires ``--within``).")
+@_genfunc2comm
+@_add2api
+def conc(vertical, query, pattr=("word", "lemma", "tag"), context=5,
+         display="word", ref=(), within=None, jobs=1):
+    """Search vertical for a sequence of tokens and output a concordance.
+
+    The ``query`` is a subset of CQL: a sequence of token constraints such as
+    ``[lemma="x" & tag!="V.*"]`` (regexes must match the whole value) or
+    ``[]`` (any token). The positional attributes are referred to by the names
+    given in ``pattr``.
+
+    Each output line consists of the tab-separated ``ref`` values, the left
+    context, the match and the right context.
+
+    The vertical is scanned line by line using a sliding window, so memory use
+    doesn't depend on the size of the structures. With ``jobs`` > 1, the
+    vertical is split at ``within`` boundaries and searched by a pool of
+    worker processes.
+
+    """
+    query = _parse_cql(query, pattr)
+    if display not in pattr:
+        raise RuntimeError(
+            "Unknown positional attribute to display: {}.".format(display))
+    display = pattr.index(display)
+    refs = []
+    for r in ref:
+        struct, sep, attr = r.partition("@")
+        if not sep:
+            raise RuntimeError("References must be of the form struct@attr, "
+                               "not {}.".format(r))
+        refs.append((struct, attr))
+    kwargs = dict(query=query, context=context, display=display,
+                  refs=tuple(refs), within=within)
+    if jobs <= 1:
+        yield from _kwic(vertical, **kwargs)
+        return
+    if within is None:
+        raise RuntimeError("Parallel search requires ``within`` to be set so "
+                           "that the vertical can be split safely.")
+    with multiprocessing.Pool(jobs) as pool:
+        yield from pool.imap(functools.partial(_kwic_batch, **kwargs),
+                             _kwic_batches(vertical, within))
+
+
+@vrt.command()
+@click.pass_context
+@_option("-c", "--column", default=[0, 1], type=int, multiple=True,
+         help="Index of positional attribute(s) to summarize (0-based).")
+@_option("-k", "--top", default=100, type=int,
+         help="Number of most frequent values to keep track of.")
+@_option("-p", "--precision", default=14, type=click.IntRange(4, 18),
+         help="Precision of the distinct value estimates (log2 of memory).")
+@_option("-m", "--merge", default=[], type=click.File("r"), multiple=True,
+         help="Merge previous outputs of ``stats`` instead of reading input.")
+@_genfunc2comm
+@_add2api
+def stats(vertical, column=(0, 1), top=100, precision=14, merge=()):
+    """Gather statistics about a vertical in one pass and output them as JSON.
+
+    These include counts of structures by tag, the number of positions, the
+    distribution of structure lengths (in positions), and the number of
+    distinct values and most frequent values of each structure attribute and
+    of the positional attributes in ``column``.
+
+    Distinct counts and top values are estimated with bounded-memory sketches
+    (HyperLogLog and Misra-Gries), which are included in the output, so that
+    statistics of several shards of a corpus can be combined with ``merge``.
+
+    """
+    if merge:
+        result = None
+        for fh in merge:
+            partial = CorpusStats.from_dict(json.load(fh))
+            if result is None:
+                result = partial
+            else:
+                result.merge(partial)
+    elif isinstance(vertical, Corpus):
+        result = CorpusStats(columns=column, k=top, precision=precision)
+        result.update_compiled(vertical)
+    else:
+        result = CorpusStats(columns=column, k=top, precision=precision)
+        for line in vertical:
+            result.update(line)
+    yield json.dumps(result.to_dict(), ensure_ascii=False, indent=2) + "\n"
+
+
+def _parse_pipeline(pipeline):
+    """Parse a pipeline of ``vrt`` commands, e.g. ``"filter -s doc -a lang cs
+    | strip"``, into a list of ``(command name, parameters)`` pairs.
+
+    """
+    stages = [[]]
+    for arg in shlex.split(pipeline):
+        if arg == "|":
+            stages.append([])
+        else:
+            stages[-1].append(arg)
+    parsed = []
+    for name, *args in stages:
+        command = vrt.commands.get(name)
+        if command is None or name not in API or name == "tee":
+            raise RuntimeError("Unsupported command in pipeline: {}.".format(
+                name))
+        cx = command.make_context(name, args)
+        parsed.append((name, cx.params))
+    return parsed
+
+
+def _tee_branch(stages, batches, output, outenc="utf-8", errors="strict"):
+    """Run a pipeline of commands on batches of lines taken from the
+    ``batches`` queue until a ``None`` is received, and write the result to
+    ``output``.
+
+    """
+    done = False
+
+    def lines():
+        nonlocal done
+        while not done:
+            batch = batches.get()
+            if batch is None:
+                done = True
+            else:
+                yield from batch
+
+    try:
+        chunks = lines()
+        for i, (name, params) in enumerate(stages):
+            chunks = API[name](linewise(chunks) if i else chunks, **params)
+        with open(output, "wb") as fh:
+            for chunk in chunks:
+                fh.write(chunk.encode(outenc, errors=errors))
+    finally:
+        # drain whatever the pipeline didn't need (or couldn't process because
+        # it failed), so that the feeder isn't blocked
+        for _ in lines():
+            pass
+
+
+def _tee_thread(stages, batches, output, failures, **kwargs):
+    try:
+        _tee_branch(stages, batches, output, **kwargs)
+    except BaseException as e:
+        failures.append((output, e))
+
+
+@vrt.command()
+@click.pass_context
+@_option("-b", "--branch", required=True, type=(str, str), multiple=True,
+         help="Pipeline of commands and the file to write its output to.")
+@_option("-P", "--processes", default=False, is_flag=True,
+         help="Run each branch in a separate process instead of a thread.")
+@_option("-n", "--batch", default=1000, type=int,
+         help="Number of lines to hand over to the branches at once.")
+@_option("-q", "--queue", "queue_size", default=64, type=int,
+         help="Number of batches a branch can lag behind the input.")
+@_genfunc2comm
+@_add2api
+def tee(vertical, branch, processes=False, batch=1000, queue_size=64,
+        outenc=None, errors=None):
+    """Read the vertical once and feed it to several pipelines of commands.
+
+    Each ``branch`` is a pair of a pipeline of ``vrt`` commands separated by
+    ``|``, e.g. ``"filter -s doc -a lang cs | strip"``, and the file to which
+    the output of the pipeline should be written. Nothing is written to the
+    standard output.
+
+    The input is handed over to the branches in batches of ``batch`` lines
+    through bounded queues, so a slow branch slows down the reading of the
+    input rather than making it pile up in memory. By default, branches run
+    in threads; with ``processes``, each one runs in a process of its own, so
+    that CPU-heavy branches can run in parallel.
+
+    The output files are written using ``outenc`` and ``errors``, which
+    default to the global options of the same name when run from the command
+    line.
+
+    """
+    outenc, errors = _output_encoding(outenc, errors)
+    branches = [(_parse_pipeline(p), output) for p, output in branch]
+    kwargs = dict(outenc=outenc, errors=errors)
+    failures = []
+    workers = []
+    if processes:
+        # fork so that the branches share the already initialized state
+        mp = multiprocessing.get_context("fork")
+        for stages, output in branches:
+            batches = mp.Queue(queue_size)
+            worker = mp.Process(target=_tee_branch, kwargs=kwargs,
+                                args=(stages, batches, output), daemon=True)
+            workers.append((worker, batches))
+    else:
+        for stages, output in branches:
+            batches = queue.Queue(queue_size)
+            worker = threading.Thread(target=_tee_thread, kwargs=kwargs,
+                                      args=(stages, batches, output, failures),
+                                      daemon=True)
+            workers.append((worker, batches))
+    for worker, _ in workers:
+        worker.start()
+
+    def put(item):
+        for worker, batches in workers:
+            while True:
+                try:
+                    batches.put(item, timeout=1)
+                    break
+                except queue.Full:
+                    if not worker.is_alive():
+                        break
+
+    lines = []
+    for line in vertical:
+        lines.append(line)
+        if len(lines) >= batch:
+            put(lines)
+            lines = []
+    if lines:
+        put(lines)
+    put(None)
+    for worker, _ in workers:
+        worker.join()
+    if processes:
+        failures = [(output, "exit code {}".format(worker.exitcode))
+                    for (worker, _), (_, output) in zip(workers, branches)
+                    if worker.exitcode]
+    if failures:
+        raise RuntimeError("Branch(es) failed: {}".format(
+            "; ".join("{} ({})".format(o, e) for o, e in failures)))
+    # nothing is output to STDOUT, but tee is a generator like the other
+    # commands
+    yield from ()
+
+
+SORT_TYPES = dict(str=str, int=int, float=float)
+
+
+def _sort_key(keys):
+    """Build a function computing the sort key of a structure (given its
+    attributes) from ``keys``, which are attribute names optionally followed
+    by ``:type`` (one of ``SORT_TYPES``). Structures missing an attribute sort
+    before all others.
+
+    """
+    parsed = []
+    for key in keys:
+        attr, _, type_ = key.partition(":")
+        try:
+            parsed.append((attr, SORT_TYPES[type_ or "str"]))
+        except KeyError as e:
+            raise RuntimeError("Unsupported sort key type: {}.".format(
+                type_)) from e
+
+    def sort_key(attrs):
+        key = []
+        for attr, type_ in parsed:
+            val = attrs.get(attr)
+            if val is None:
+                key.append((0, type_()))
+                continue
+            try:
+                key.append((1, type_(val)))
+            except ValueError as e:
+                raise RuntimeError("Can't compare value {!r} of attribute {} "
+                                   "as {}.".format(val, attr, type_.__name__)
+                                   ) from e
+        return tuple(key)
+
+    return sort_key
+
+
+def _read_run(path):
+    with open(path, "rb") as fh:
+        while True:
+            try:
+                yield pickle.load(fh)
+            except EOFError:
+                return
+
+
+# number of runs merged at once, so as to stay well below the limit on open
+# files; with more runs, they are merged in several passes
+MERGE_FANIN = 64
+
+
+@vrt.command()
+@click.pass_context
+@_option("-s", "--struct", default="doc", type=str,
+         help="Structures into which the vertical will be split.")
+@_option("-k", "--key", required=True, type=str, multiple=True,
+         help="Attribute to sort by, optionally typed, e.g. year:int.")
+@_option("-r", "--reverse", default=False, is_flag=True,
+         help="Sort in descending order.")
+@_option("-m", "--memory", default=512, type=int,
+         help="Approximate memory budget in MiB.")
+@_option("-T", "--tmpdir", default=None, type=click.Path(file_okay=False),
+         help="Directory for temporary files.")
+@_genfunc2comm
+@_add2api
+def sort(vertical, struct, key, reverse=False, memory=512, tmpdir=None):
+    """Sort structures in vertical according to attribute value(s).
+
+    All structures above ``struct`` are discarded. Structures are compared
+    according to the values of the attributes in ``key``, in order. Each key
+    can be suffixed with ``:int`` or ``:float`` to compare values as numbers
+    instead of strings. The sort is stable.
+
+    When the structures don't fit into the ``memory`` budget, sorted runs are
+    written to temporary files in ``tmpdir`` and merged afterwards (external
+    merge sort), up to 64 at a time.
+
+    """
+    sort_key = _sort_key(key)
+    budget = memory * 2 ** 20
+    with tempfile.TemporaryDirectory(prefix="pyvert-sort-", dir=tmpdir) as tmp:
+        runs = []
+        run, size = [], 0
+        names = itertools.count()
+
+        def write(records):
+            path = os.path.join(tmp, "run{}".format(next(names)))
+            with open(path, "wb") as fh:
+                for record in records:
+                    pickle.dump(record, fh, protocol=pickle.HIGHEST_PROTOCOL)
+            return path
+
+        def merge(paths):
+            return heapq.merge(*map(_read_run, paths),
+                               key=operator.itemgetter(0), reverse=reverse)
+
+        def flush(run):
+            run.sort(key=operator.itemgetter(0), reverse=reverse)
+            runs.append(write(run))
+
+        for s in pyvert.iterstruct(vertical, struct=struct):
+            run.append((sort_key(s.attr), s.raw))
+            # rough estimate of the memory taken up by the record
+            size += sys.getsizeof(s.raw) + 200
+            if size >= budget:
+                flush(run)
+                run, size = [], 0
+        if not runs:
+            run.sort(key=operator.itemgetter(0), reverse=reverse)
+            for _, raw in run:
+                yield raw
+            return
+        if run:
+            flush(run)
+            run = None
+        # merging consecutive runs keeps the sort stable
+        while len(runs) > MERGE_FANIN:
+            paths, runs = runs, []
+            for i in range(0, len(paths), MERGE_FANIN):
+                batch = paths[i:i + MERGE_FANIN]
+                runs.append(write(merge(batch)))
+                for path in batch:
+                    os.remove(path)
+        for _, raw in merge(runs):
+            yield raw
+
+
+@vrt.command()
+@click.pass_context
+@_option("-s", "--struct", default="doc", type=str,
+         help="Structures into which the vertical will be split.")
+@_option("-c", "--content-only", default=False, is_flag=True,
+         help="Ignore the attributes of ``struct`` when comparing.")
+@_genfunc2comm
+@_add2api
+def dedup(vertical, struct, content_only=False):
+    """Remove duplicate structures from vertical.
+
+    All structures above ``struct`` are discarded. Only the first of several
+    structures with identical content is kept. With ``content_only``,
+    structures differing only in the attributes on their start tag are
+    considered identical too.
+
+    Only a 16-byte hash of each distinct structure is kept in memory.
+
+    """
+    seen = set()
+    for s in pyvert.iterstruct(vertical, struct=struct):
+        text = s.raw
+        if content_only:
+            text = text.split("\n", maxsplit=1)[1]
+        digest = hashlib.blake2b(text.encode("utf-8", errors="surrogatepass"),
+                                 digest_size=16).digest()
+        if digest not in seen:
+            seen.add(digest)
+            yield s.raw
+
+
+def _band_keys(raw, minhash, column, shingle):
+    """Shingle the values of ``column`` in a structure and compute the LSH
+    band keys of its MinHash signature.
+
+    """
+    tokens = []
+    for line in raw.split("\n"):
+        if not line or line[0] == "<" and line[-1] == ">":
+            continue
+        cols = line.split("\t", column + 1)
+        if column < len(cols):
+            tokens.append(cols[column])
+    if len(tokens) <= shingle:
+        shingles = [" ".join(tokens)] if tokens else []
+    else:
+        shingles = (" ".join(tokens[i:i + shingle])
+                    for i in range(len(tokens) - shingle + 1))
+    return minhash.band_keys(shingles)
+
+
+@vrt.command()
+@click.pass_context
+@_option("-s", "--struct", default="doc", type=str,
+         help="Structures to compare.")
+@_option("-c", "--column", default=0, type=int,
+         help="Index of the positional attribute to compare (0-based).")
+@_option("-n", "--shingle", default=5, type=int,
+         help="Length of the shingles (token n-grams).")
+@_option("-b", "--bands", default=16, type=int,
+         help="Number of LSH bands.")
+@_option("-r", "--rows", default=8, type=int,
+         help="Number of MinHash values per band.")
+@_option("-m", "--mode", default="drop", type=click.Choice(["drop", "annotate"]),
+         help="Drop near-duplicates or annotate structures with a cluster id.")
+@_option("-a", "--attr", default="dup_cluster", type=str,
+         help="Attribute to store the cluster id in (``annotate`` mode).")
+@_option("-x", "--index-size", default=24, type=click.IntRange(10, 34),
+         help="Log2 of the number of slots in the LSH index (8 bytes each).")
+@_option("-j", "--jobs", default=1, type=int,
+         help="Number of worker processes computing signatures.")
+@_genfunc2comm
+@_add2api
+def neardup(vertical, struct, column=0, shingle=5, bands=16, rows=8,
+            mode="drop", attr="dup_cluster", index_size=24, jobs=1):
+    """Detect near-duplicate structures in vertical.
+
+    All structures above ``struct`` are discarded. Each structure is
+    represented by the set of its ``shingle``-grams of positional attribute
+    ``column``, and structures are compared by estimating the Jaccard
+    similarity of these sets with MinHash and locality-sensitive hashing:
+    structures which share at least one of ``bands`` bands of ``rows``
+    MinHash values are considered near-duplicates. The similarity threshold
+    is roughly ``(1 / bands) ** (1 / rows)``.
+
+    In ``drop`` mode, only the first structure of each cluster of
+    near-duplicates is kept. In ``annotate`` mode, all structures are kept and
+    ``attr`` is set to the ordinal of the first structure in their cluster.
+
+    The LSH index has a fixed size of ``2 ** index_size`` slots, so memory use
+    doesn't grow with the number of structures. Signatures can be computed by
+    a pool of ``jobs`` worker processes.
+
+    """
+    minhash = MinHash(bands, rows)
+    index = LSHIndex(2 ** index_size)
+    keys = functools.partial(_band_keys, minhash=minhash, column=column,
+                             shingle=shingle)
+    pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+    try:
+        i = 0
+        structs = pyvert.iterstruct(vertical, struct=struct)
+        # bound the number of structures in flight
+        for batch in _batched(structs, 256 * jobs):
+            raws = [s.raw for s in batch]
+            if pool is None:
+                batch_keys = map(keys, raws)
+            else:
+                batch_keys = pool.map(keys, raws, chunksize=64)
+            for raw, band_keys in zip(raws, batch_keys):
+                cluster = None
+                for key in band_keys:
+                    cluster = index.get(key)
+                    if cluster is not None:
+                        break
+                if cluster is None:
+                    cluster = i
+                    for key in band_keys:
+                        index.add(key, cluster)
+                elif mode == "drop":
+                    i += 1
+                    continue
+                else:
+                    # extend the cluster with the bands it didn't share yet
+                    for key in band_keys:
+                        if index.get(key) is None:
+                            index.add(key, cluster)
+                i += 1
+                if mode == "annotate":
+                    start, rest = raw.split("\n", maxsplit=1)
+                    raw = _set_attr(start, attr, str(cluster)) + "\n" + rest
+                yield raw
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
+def _seekable_buffer(vertical):
+    """Return the binary buffer underlying ``vertical`` if it's a seekable
+    file which hasn't been read from yet, otherwise None.
+
+    """
+    try:
+        buffer = vertical.buffer
+        if buffer.seekable() and vertical.tell() == buffer.tell():
+            return buffer
+    except (AttributeError, OSError, ValueError):
+        pass
+    return None
+
+
+def _iterstruct_offsets(buffer, struct, encoding="utf-8", errors="strict"):
+    """Like ``pyvert.iterstruct()``, but yield just the attributes and the
+    start and end byte offsets of each structure in a binary file.
+
+    """
+    start = re.compile(r"<{}(?:\s.*?)?>".format(re.escape(struct)).encode())
+    end = "</{}>".format(struct).encode()
+    offset = buffer.tell()
+    begin = attr = None
+    for line in buffer:
+        stripped = line.strip()
+        if begin is None and start.fullmatch(stripped):
+            begin = offset
+            attr = dict(ATTR.findall(stripped.decode(encoding, errors)))
+        offset += len(line)
+        if begin is not None and stripped == end:
+            yield attr, begin, offset
+            begin = None
+
+
+@vrt.command()
+@click.pass_context
+@_option("-s", "--struct", default="doc", type=str,
+         help="Structures to sample.")
+@_option("-k", "--size", default=100, type=int,
+         help="Number of structures to sample (per stratum).")
+@_option("-b", "--by", default=None, type=str,
+         help="Attribute whose values define the strata.")
+@_option("--seed", default=1, type=int,
+         help="Seed of the random number generator.")
+@_genfunc2comm
+@_add2api
+def sample(vertical, struct, size=100, by=None, seed=1):
+    """Output a random sample of structures in vertical.
+
+    All structures above ``struct`` are discarded. ``size`` structures are
+    chosen with uniform probability using reservoir sampling; if ``by`` is
+    given, ``size`` structures are chosen for each value of that attribute
+    (stratified sampling). The sample is output in the original order and is
+    replicable across runs given the same ``seed``.
+
+    If the input is a seekable file, only byte offsets of the sampled
+    structures are kept in memory and the structures themselves are read in a
+    second pass, otherwise the sampled structures are kept in memory.
+
+    """
+    rng = random.Random(seed)
+    buffer = _seekable_buffer(vertical)
+    if buffer is not None:
+        encoding, errors = vertical.encoding, vertical.errors
+        items = ((attr, (begin, end)) for attr, begin, end in
+                 _iterstruct_offsets(buffer, struct, encoding, errors))
+    else:
+        items = ((s.attr, s.raw) for s in
+                 pyvert.iterstruct(vertical, struct=struct))
+    # stratum -> [number of structures seen, reservoir]
+    strata = {}
+    for i, (attr, item) in enumerate(items):
+        stratum = strata.setdefault(attr.get(by, "") if by else None, [0, []])
+        seen, reservoir = stratum
+        if seen < size:
+            reservoir.append((i, item))
+        else:
+            j = rng.randrange(seen + 1)
+            if j < size:
+                reservoir[j] = (i, item)
+        stratum[0] += 1
+    chosen = sorted(itertools.chain.from_iterable(r for _, r in
+                                                  strata.values()))
+    for _, item in chosen:
+        if buffer is None:
+            yield item
+            continue
+        begin, end = item
+        buffer.seek(begin)
+        text = buffer.read(end - begin).decode(encoding, errors)
+        yield "\n".join(line.strip() for line in text.split("\n")).strip() \
+            + "\n"
+
+
+class _WriterPool:
+    """Buffered writers to many files with a bounded number of open handles.
+
+    Text is buffered per file and flushed when the buffer grows over
+    ``buffer_size`` characters. When more than ``max_open`` files would be
+    open, the least recently used one is closed and later reopened in append
+    mode. Files with a ``.gz``, ``.bz2`` or ``.xz`` extension are compressed
+    (appending creates additional streams, which decompressors handle
+    transparently).
+
+    """
+    def __init__(self, max_open=64, buffer_size=2 ** 20, encoding="utf-8",
+                 errors="strict"):
+        self.max_open = max_open
+        self.buffer_size = buffer_size
+        self.encoding = encoding
+        self.errors = errors
+        self.handles = collections.OrderedDict()
+        self.buffers = {}
+        self.created = set()
+
+    def write(self, path, text):
+        buffer = self.buffers.setdefault(path, [0, []])
+        buffer[0] += len(text)
+        buffer[1].append(text)
+        if buffer[0] >= self.buffer_size:
+            self._flush(path)
+
+    def _handle(self, path):
+        fh = self.handles.get(path)
+        if fh is not None:
+            self.handles.move_to_end(path)
+            return fh
+        if len(self.handles) >= self.max_open:
+            _, lru = self.handles.popitem(last=False)
+            lru.close()
+        mode = "at" if path in self.created else "wt"
+        compressor = COMPRESSORS.get(os.path.splitext(path)[1])
+        opener = open if compressor is None else compressor.open
+        fh = opener(path, mode, encoding=self.encoding, errors=self.errors)
+        self.created.add(path)
+        self.handles[path] = fh
+        return fh
+
+    def _flush(self, path):
+        _, texts = self.buffers.pop(path)
+        self._handle(path).write("".join(texts))
+
+    def close(self):
+        try:
+            for path in list(self.buffers):
+                self._flush(path)
+        finally:
+            for fh in self.handles.values():
+                fh.close()
+            self.handles.clear()
+
+
+@vrt.command()
+@click.pass_context
+@_option("-s", "--struct", default="doc", type=str,
+         help="Structures to distribute among the outputs.")
+@_option("-m", "--mode", default="round-robin",
+         type=click.Choice(["round-robin", "hash", "value"]),
+         help="How to assign structures to outputs.")
+@_option("-n", "--parts", default=2, type=click.IntRange(1),
+         help="Number of outputs (``round-robin`` and ``hash`` modes).")
+@_option("-a", "--attr", default=None, type=str,
+         help="Attribute to hash or whose values to split by.")
+@_option("-o", "--output", default="part-{}.vrt", type=str,
+         help="Template of output paths, {} is replaced by the part.")
+@_option("--max-open", default=64, type=click.IntRange(1),
+         help="Maximum number of simultaneously open output files.")
+@_option("--buffer", "buffer_size", default=1024, type=click.IntRange(1),
+         help="Size of the buffer of each output in KiB.")
+@_genfunc2comm
+@_add2api
+def split(vertical, struct, mode="round-robin", parts=2, attr=None,
+          output="part-{}.vrt", max_open=64, buffer_size=1024, outenc=None,
+          errors=None):
+    """Partition the structures in vertical into several files in one pass.
+
+    All structures above ``struct`` are discarded. In ``round-robin`` mode,
+    structures are dealt out to ``parts`` outputs in turn; in ``hash`` mode,
+    they are assigned according to a (stable) hash of attribute ``attr``, so
+    that structures sharing its value end up in the same output; in ``value``
+    mode, there is one output per value of ``attr``. The outputs are named
+    after the ``output`` template, with ``{}`` replaced by the number of the
+    part or the attribute value. Outputs whose name ends with ``.gz``,
+    ``.bz2`` or ``.xz`` are compressed. Nothing is written to the standard
+    output.
+
+    The outputs are written through buffers of ``buffer_size`` KiB and at
+    most ``max_open`` of them are open at any time.
+
+    """
+    if mode != "round-robin" and attr is None:
+        raise RuntimeError("Splitting in {} mode requires an attribute."
+                           .format(mode))
+    if "{}" not in output:
+        raise RuntimeError("Output template must contain {}.")
+    outenc, errors = _output_encoding(outenc, errors)
+    writers = _WriterPool(max_open, buffer_size * 1024, outenc, errors)
+    try:
+        for i, s in enumerate(pyvert.iterstruct(vertical, struct=struct)):
+            if mode == "round-robin":
+                part = i % parts
+            else:
+                try:
+                    value = s.attr[attr]
+                except KeyError as e:
+                    raise RuntimeError("Structure does not contain specified "
+                                       "attribute.") from e
+                if mode == "hash":
+                    part = zlib.crc32(value.encode("utf-8")) % parts
+                else:
+                    part = value.replace(os.sep, "_") or "_"
+            writers.write(output.format(part), s.raw)
+    finally:
+        writers.close()
+    # nothing is output to STDOUT, but split is a generator like the other
+    # commands
+    yield from ()
 
 
 @vrt.command()
@@ -269,9 +1896,109 @@ def project(vertical, parent, child):
     existing attributes in the child structure.
 
     """
-    for struct in pyvert.iterstruct(vertical, struct=parent):
-        struct.project(child=child)
-        yield etree.tounicode(struct.xml)
+    cache = _cache("project", parent=parent, child=child)
+    # the text is only needed as the cache key
+    cached = not isinstance(cache, DummyCache)
+    structs = pyvert.iterstruct(vertical, struct=parent,
+                                incremental=_incremental(), keep_raw=cached)
+
+    def lookup():
+        for struct in structs:
+            key = cache.key(struct.raw) if cached else None
+            yield struct, key, cache.get(key)
+
+    def project_struct(item):
+        struct, key, projected = item
+        if projected is None:
+            struct.project(child=child)
+            return key, etree.tounicode(struct.xml), True
+        return key, projected, False
+
+    for key, projected, new in _threaded(project_struct, lookup(),
+                                         _threads("project")):
+        if new:
+            cache.put(key, projected)
+        yield projected
+
+
+@vrt.command()
+@click.pass_context
+@_option("-t", "--table", required=True,
+         type=click.Path(exists=True, dir_okay=False),
+         help="TSV file of metadata with a header; keys in the first column.")
+@_option("-s", "--struct", default="doc", type=str,
+         help="Structure to add the metadata to.")
+@_option("-a", "--attr", default="id", type=str,
+         help="Attribute of the structure to look up in the table.")
+@_option("-p", "--prefix", default="", type=str,
+         help="Prefix of the names of the added attributes.")
+@_option("-w", "--overwrite", default=False, is_flag=True,
+         help="Overwrite existing attributes of the same name.")
+@_option("-m", "--memory", default=512, type=int,
+         help="Tables bigger than this (in MiB) are indexed on disk.")
+@_option("-T", "--tmpdir", default=None, type=click.Path(file_okay=False),
+         help="Directory for the on-disk index.")
+@_genfunc2comm
+@_add2api
+def annotate(vertical, table, struct="doc", attr="id", prefix="",
+             overwrite=False, memory=512, tmpdir=None):
+    """Add metadata from a ``table`` to ``struct`` structures.
+
+    The table is a UTF-8 encoded TSV file. Its first row holds the column
+    names and its first column holds keys, which are matched against the
+    ``attr`` attribute of the structures. The values in the other columns of
+    the matching row are added as attributes named after the columns, with
+    an optional ``prefix``. Unless ``overwrite`` is given, the same rules as
+    in ``project`` apply: columns which the structure already has an
+    attribute of the same (unprefixed) name for are skipped, and prefixed
+    names are postfixed with underscores if necessary so as to avoid
+    collisions.
+
+    The table is loaded into an in-memory index, or into an on-disk one in
+    ``tmpdir`` if it's bigger than ``memory`` would allow. The vertical is
+    processed line by line and output verbatim, except for the start tags of
+    the annotated structures.
+
+    """
+    index = load_table(table, memory * 2 ** 20, tmpdir)
+    try:
+        names = [prefix + name for name in index.names]
+        invalid = [name for name in names if not re.fullmatch(r"\w+", name)]
+        if invalid:
+            raise RuntimeError("Invalid attribute names in {}: {}".format(
+                table, ", ".join(invalid)))
+        start = "<" + struct
+        annotated = missing = 0
+        # lines are output in batches, which is much faster than one by one
+        for lines in _batched(vertical, 1000):
+            for i, line in enumerate(lines):
+                if start not in line:
+                    continue
+                stripped = line.strip()
+                s = START_TAG.fullmatch(stripped)
+                if not s or s.group(1) != struct:
+                    continue
+                attrs = dict(ATTR.findall(s.group(2)))
+                row = index.get(attrs.get(attr))
+                if row is None:
+                    missing += 1
+                    continue
+                for name, value in zip(index.names, row):
+                    if overwrite:
+                        name = prefix + name
+                    else:
+                        name = _projected_key(name, prefix, attrs)
+                        if name is None:
+                            continue
+                    attrs[name] = value
+                    stripped = _set_attr(stripped, name, value)
+                annotated += 1
+                lines[i] = stripped + "\n"
+            yield "".join(lines)
+        logging.info("Annotated {} structures, {} had no metadata.".format(
+            annotated, missing), extra=dict(command="annotate"))
+    finally:
+        index.close()
 
 
 @vrt.command()
@@ -312,8 +2039,10 @@ def wrap(vertical, target, attr, name="wrap"):
     val`` pairs (for all attributes specified under ``attr``) are the same.
 
     """
-    last_attr = None
-    for i, struct in enumerate(pyvert.iterstruct(vertical, struct=target)):
+    checkpoint = _checkpoint("wrap")
+    last_attr = checkpoint.state.get("last_attr")
+    structs = pyvert.iterstruct(vertical, struct=target)
+    for i, struct in enumerate(structs, start=checkpoint.start):
         try:
             new_attr = ",".join(struct.attr[a] for a in attr)
         except KeyError as e:
@@ -325,6 +2054,7 @@ def wrap(vertical, target, attr, name="wrap"):
             yield '<{} id="{}_{}">\n'.format(name, new_attr, i)
         yield struct.raw
         last_attr = new_attr
+        checkpoint.mark(i, last_attr=last_attr)
     yield "</{}>\n".format(name)
 
 
@@ -348,9 +2078,20 @@ def identify(vertical, struct, base="id_", attr="id"):
     """
     # TODO: iterate over lines instead so as not to drop structures above
     # ``struct`` (→ change docstring when it's done)
-    for i, struct in enumerate(pyvert.iterstruct(vertical, struct=struct)):
+    checkpoint = _checkpoint("identify")
+    structs = pyvert.iterstruct(vertical, struct=struct,
+                                incremental=_incremental())
+
+    def identify_struct(item):
+        i, struct = item
         struct.xml.attrib[attr] = base + str(i)
-        yield etree.tounicode(struct.xml)
+        return i, etree.tounicode(struct.xml)
+
+    for i, identified in _threaded(
+            identify_struct, enumerate(structs, start=checkpoint.start),
+            _threads("identify")):
+        yield identified
+        checkpoint.mark(i)
 
 
 @vrt.command()
@@ -379,45 +2120,36 @@ def tag(vertical, tagger, struct, sent, extended):
             "either via the corresponding parameter (used repeatedly if "
             "necessary) or via the ``PYVERT_STRUCTS`` environment variable.")
     struct = re.compile("^</?(?:" + "|".join(struct) + ").*?>")
-    sent_end = re.compile("^</(?:" + "|".join(sent) + ")\s*>")
-    try:
-        import ufal.morphodita as md
-    except ImportError as e:
-        raise RuntimeError(
-            "The ``tag`` subcommand needs the MorphoDiTa library and its Python "
-            "bindings; see http://ufal.mff.cuni.cz/morphodita, or simply run "
-            "``pip3 install --user ufal.morphodita``.") from e
-    logging.info("Loading tagger.", extra=dict(command="tag"))
-    tagger, tagger_file = md.Tagger.load(tagger), tagger
-    if tagger is None:
-        raise RuntimeError(
-            "Unable to load tagger from file {}.".format(tagger_file))
-    forms = md.Forms()
-    lemmas = md.TaggedLemmas()
-    tokens = md.TokenRanges()
-    tokenizer = md.Tokenizer.newVerticalTokenizer()
-    morpho = tagger.getMorpho()
-    converter = md.TagsetConverter.newStripLemmaIdConverter(morpho)
+    sent_end = re.compile("^</(?:" + "|".join(sent) + ")\\s*>")
+    checkpoint = _checkpoint("tag")
+    stat = os.stat(tagger)
+    cache = _cache("tag", tagger=os.path.abspath(tagger),
+                   tagger_mtime=stat.st_mtime, tagger_size=stat.st_size,
+                   struct=struct.pattern, sent=sent, extended=extended)
+    # the tagger is loaded lazily, it isn't needed if all sentences are cached
+    tag_sentence = None
+    sentences = checkpoint.start
     s_buffer = []
     t_buffer = ""
+    raw = []
     for line in vertical:
+        raw.append(line)
         if sent_end.match(line):
             s_buffer.append(line)
             t_buffer += "\n"
-            tokenizer.setText(t_buffer)
-            tokenizer.nextSentence(forms, tokens)
-            tagger.tag(forms, lemmas)
-            tagged_iter = zip(forms, lemmas)
-            for s in s_buffer:
-                if s is None:
-                    w, l = next(tagged_iter)
-                    if not extended:
-                        converter.convert(l)
-                    yield "{}\t{}\t{}\n".format(w, l.lemma, l.tag)
-                else:
-                    yield s
+            key = cache.key("".join(raw))
+            tagged = cache.get(key)
+            if tagged is None:
+                if tag_sentence is None:
+                    tag_sentence = _load_tagger(tagger, extended)
+                tagged = tag_sentence(s_buffer, t_buffer)
+                cache.put(key, tagged)
+            yield tagged
             s_buffer = []
             t_buffer = ""
+            raw = []
+            checkpoint.mark(sentences)
+            sentences += 1
         elif struct.match(line):
             s_buffer.append(line)
         else:
@@ -433,6 +2165,54 @@ def tag(vertical, tagger, struct, sent, extended):
         yield s
 
 
+# memoized so that the tagger stays loaded between files in batch mode
+@functools.lru_cache(maxsize=None)
+def _load_tagger(tagger_file, extended):
+    """Load a MorphoDiTa tagger and return a function which tags a sentence.
+
+    The function takes a list of the lines of the sentence, where lines with
+    tokens are replaced by None, and the tokens themselves, one per line. It
+    returns the tagged sentence, including structure lines.
+
+    """
+    try:
+        import ufal.morphodita as md
+    except ImportError as e:
+        raise RuntimeError(
+            "The ``tag`` subcommand needs the MorphoDiTa library and its Python "
+            "bindings; see http://ufal.mff.cuni.cz/morphodita, or simply run "
+            "``pip3 install --user ufal.morphodita``.") from e
+    logging.info("Loading tagger.", extra=dict(command="tag"))
+    tagger = md.Tagger.load(tagger_file)
+    if tagger is None:
+        raise RuntimeError(
+            "Unable to load tagger from file {}.".format(tagger_file))
+    forms = md.Forms()
+    lemmas = md.TaggedLemmas()
+    tokens = md.TokenRanges()
+    tokenizer = md.Tokenizer.newVerticalTokenizer()
+    morpho = tagger.getMorpho()
+    converter = md.TagsetConverter.newStripLemmaIdConverter(morpho)
+
+    def tag_sentence(s_buffer, t_buffer):
+        tokenizer.setText(t_buffer)
+        tokenizer.nextSentence(forms, tokens)
+        tagger.tag(forms, lemmas)
+        tagged_iter = zip(forms, lemmas)
+        tagged = []
+        for s in s_buffer:
+            if s is None:
+                w, l = next(tagged_iter)
+                if not extended:
+                    converter.convert(l)
+                tagged.append("{}\t{}\t{}\n".format(w, l.lemma, l.tag))
+            else:
+                tagged.append(s)
+        return "".join(tagged)
+
+    return tag_sentence
+
+
 @vrt.command()
 @click.pass_context
 @_genfunc2comm
@@ -441,6 +2221,9 @@ def strip(vertical):
     """Strip positional attributes other than the first one.
 
     """
+    if isinstance(vertical, Corpus):
+        yield from vertical.lines(columns=range(min(1, len(vertical.ids))))
+        return
     word = re.compile(r"^([^\t]+).*?(\s{0,2})$")
     struct = re.compile(r"^<.*?>\s*$")
     for line in vertical:
@@ -449,6 +2232,117 @@ def strip(vertical):
         yield line
 
 
+@vrt.command("compile")
+@click.pass_context
+@click.argument("corpus", type=click.Path(dir_okay=False))
+@_option("-T", "--tmpdir", default=None, type=click.Path(file_okay=False),
+         help="Directory for temporary files.")
+@_genfunc2comm
+@_add2api
+def compile_corpus(vertical, corpus, tmpdir=None):
+    """Compile vertical into a binary CORPUS file.
+
+    Each positional attribute gets a lexicon of its distinct values and
+    positions are stored as arrays of integer ids; structures are stored as
+    start and end positions along with their tags. The file is
+    memory-mapped when given as ``--input`` to other commands, which then
+    don't need to parse the text of the vertical again. ``vrt decompile``
+    turns it back into the original vertical.
+
+    Nothing is written to the standard output.
+
+    """
+    if isinstance(vertical, Corpus):
+        raise RuntimeError("Input is already compiled.")
+    compile_vertical(vertical, corpus, tmpdir)
+    # nothing is output to STDOUT, but this is a generator like the other
+    # commands
+    yield from ()
+
+
+@vrt.command()
+@click.pass_context
+@_genfunc2comm
+@_add2api
+def decompile(vertical):
+    """Output the vertical a compiled corpus was compiled from.
+
+    """
+    if not isinstance(vertical, Corpus):
+        raise RuntimeError("Input is not a compiled corpus.")
+    for batch in _batched(vertical.lines(), 10000):
+        yield "".join(batch)
+
+
+@vrt.command()
+@click.pass_context
+@_option("-c", "--columns", default=None, type=click.IntRange(1),
+         help="Expected number of positional attributes [default: as many "
+         "as in the first position].")
+@_option("-s", "--struct", type=str, multiple=True, default=PYVERT_STRUCTS,
+         help="Strings to be considered valid struct names [default: any].")
+@_option("-j", "--jobs", default=1, type=click.IntRange(1),
+         help="Number of shards of the input to validate in parallel.")
+@_genfunc2comm
+@_add2api
+def validate(vertical, columns=None, struct=(), jobs=1):
+    """Check that vertical is well-formed.
+
+    All problems found are output, one per line, as the byte offset and line
+    number where they occur and a description, ordered by offset: invalid
+    byte sequences in the input encoding, unclosed structures and stray end
+    tags, malformed or duplicate attributes, and positions with a different
+    number of positional attributes than expected. If there are any, the
+    command fails at the end.
+
+    Any line which looks like a tag is considered a structure tag, unless a
+    list of valid ``struct`` names is given (which can also be done via the
+    ``PYVERT_STRUCTS`` environment variable).
+
+    With ``jobs`` > 1, an input file is split into as many byte ranges, which
+    are validated in parallel and the results combined.
+
+    """
+    buffer = getattr(vertical, "buffer", None)
+    if buffer is None:
+        raise RuntimeError("Only verticals in text files can be validated.")
+    encoding, structs = vertical.encoding, set(struct) or None
+    # the readers used for --checkpoint and --follow have no name of their
+    # own, but their buffer does
+    name = getattr(vertical, "name", getattr(buffer, "name", "<stdin>"))
+    if jobs > 1 and os.path.isfile(name):
+        if columns is None:
+            # shards have to agree on the expected number of columns
+            probe = Validator(encoding, structs=structs)
+            with open(name, "rb") as fh:
+                for raw in fh:
+                    probe.feed([raw])
+                    if probe.columns is not None:
+                        break
+            columns = probe.columns
+        size = os.path.getsize(name)
+        bounds = [size * i // jobs for i in range(jobs + 1)]
+        with multiprocessing.Pool(jobs) as pool:
+            shards = pool.starmap(validate_range, [
+                (name, start, end, encoding, columns, structs)
+                for start, end in zip(bounds, bounds[1:])])
+        validator = Validator(encoding, columns, structs)
+        for shard in shards:
+            validator.merge(shard)
+    else:
+        if jobs > 1:
+            logging.warning("Input is not a regular file, validating it in a "
+                            "single process.", extra=dict(command="validate"))
+        validator = Validator(encoding, columns, structs)
+        validator.check(buffer)
+    problems = sorted(validator.finish().problems)
+    for offset, line, message in problems:
+        yield "{}\t{}\t{}\n".format(offset, line, message)
+    if problems:
+        raise RuntimeError("Found {} problems in {}.".format(len(problems),
+                                                             name))
+
+
 def decorate(vertical):
     """Add a sequential index to vertical positions.
 
@@ -2,9 +2,16 @@
 
 import pytest
 from pyvert.vrt import vrt
+from pyvert._cache import StructCache
 from click.testing import CliRunner
 
 import os
+import sys
+import gzip
+import json
+import time
+import threading
+import subprocess
 
 R = CliRunner()
 ACCESSED = set()
@@ -55,6 +62,205 @@ def test_filter(fix):
     assert ans.output == fix.test2_filter1
 
 
+@pytest.mark.parametrize("fix", [Fix(), Fix(True)])
+def test_grep(fix):
+    ans = R.invoke(vrt, opt("grep -s chunk -p foo"), input=fix.test2)
+    assert ans.exit_code == 0
+    assert ans.output == fix.test2_filter1
+
+    ans = R.invoke(vrt, opt("grep -s chunk -p QUX -p xyz -i -m none"),
+                   input=fix.test2)
+    assert ans.exit_code == 0
+    assert ans.output == fix.test2_filter1
+
+
+@pytest.mark.parametrize("fix", [Fix(), Fix(True)])
+def test_conc(fix):
+    query = ["-q", '[lemma="cat"][tag="V.*"]']
+    ans = R.invoke(vrt, opt("conc -c 1 -r doc@id") + query, input=fix.test4)
+    assert ans.exit_code == 0
+    assert ans.output == ("d1\tThe\tcat sat\tA\n"
+                          "d2\tbarked\tCats sleep\t\n")
+
+    expected = "d1\tThe\tcat sat\t\nd2\t\tCats sleep\t\n"
+    ans = R.invoke(vrt, opt("conc -c 1 -r doc@id -w s") + query,
+                   input=fix.test4)
+    assert ans.exit_code == 0
+    assert ans.output == expected
+
+    ans = R.invoke(vrt, opt("conc -c 1 -r doc@id -w s -j 2") + query,
+                   input=fix.test4)
+    assert ans.exit_code == 0
+    assert ans.output == expected
+
+
+def test_stats(tmpdir, fix=Fix()):
+    ans = R.invoke(vrt, opt("stats -c 1 -c 2"), input=fix.test4)
+    assert ans.exit_code == 0
+    stats = json.loads(ans.output)
+    assert stats["structures"] == {"doc": 2, "s": 3}
+    assert stats["positions"] == 8
+    assert stats["lengths"]["s"]["histogram"] == {"2": 1, "3": 2}
+    assert stats["attributes"]["doc@genre"]["distinct"] == 2
+    assert stats["columns"]["1"]["distinct"] == 7
+    assert stats["columns"]["1"]["top"][0] == ["cat", 2]
+    assert stats["columns"]["2"]["top"][0] == ["DT", 2]
+
+    shard = tmpdir.join("shard.json")
+    shard.write(ans.output)
+    ans = R.invoke(vrt, opt("stats -m {0} -m {0}".format(shard)))
+    assert ans.exit_code == 0
+    merged = json.loads(ans.output)
+    assert merged["positions"] == 16
+    assert merged["lengths"]["s"]["histogram"] == {"2": 2, "3": 4}
+    assert merged["columns"]["1"]["distinct"] == 7
+    assert merged["columns"]["1"]["top"][0] == ["cat", 4]
+
+    ans = R.invoke(vrt, opt("stats"),
+                   input='<doc a="1">\n<!-- c -->\nx\n</doc>')
+    assert ans.exit_code == 0
+    stats = json.loads(ans.output)
+    assert stats["positions"] == 1
+    assert stats["lengths"]["doc"]["histogram"] == {"1": 1}
+
+
+@pytest.mark.parametrize("processes", ["", "-P"])
+def test_tee(tmpdir, processes, fix=Fix()):
+    out1, out2 = tmpdir.join("out1.vrt"), tmpdir.join("out2.vrt")
+    args = ["tee", "-n", "3", "-q", "1",
+            "-b", "filter -s chunk -a author foo", str(out1),
+            "-b", "grep -s chunk -p qux | wrap -t chunk -a author", str(out2)]
+    if processes:
+        args.append(processes)
+    ans = R.invoke(vrt, opt("") + args, input=fix.test2)
+    assert ans.exit_code == 0
+    assert ans.output == ""
+    assert out1.read() == fix.test2_filter1
+    assert out2.read() == ('<wrap id="bar_0">\n<chunk author="bar">\nbar\nbaz\n'
+                           'qux\n</chunk>\n<chunk author="bar">\nbar\nbaz\n'
+                           'qux\n</chunk>\n</wrap>\n')
+
+    # a failing branch is reported instead of blocking the others
+    args = ["tee", "-n", "1", "-q", "1", "-b", "strip", str(out1),
+            "-b", "wrap -t chunk -a missing", str(out2)]
+    if processes:
+        args.append(processes)
+    ans = R.invoke(vrt, opt("") + args, input=fix.test2)
+    assert ans.exit_code != 0
+    assert out1.read() == fix.test2.rstrip() + "\n"
+
+
+SORT_INPUT = ('<doc n="10" t="b">\nx\n</doc>\n<doc n="9" t="a">\ny\n</doc>\n'
+              '<doc t="c">\nz\n</doc>\n<doc n="10" t="a">\nx\n</doc>\n')
+
+
+@pytest.mark.parametrize("memory", ["0", "512"])
+def test_sort(memory):
+    ans = R.invoke(vrt, opt("sort -k n:int -m " + memory), input=SORT_INPUT)
+    assert ans.exit_code == 0
+    assert ans.output == ('<doc t="c">\nz\n</doc>\n<doc n="9" t="a">\ny\n'
+                          '</doc>\n<doc n="10" t="b">\nx\n</doc>\n'
+                          '<doc n="10" t="a">\nx\n</doc>\n')
+
+    ans = R.invoke(vrt, opt("sort -k n -k t -r -m " + memory),
+                   input=SORT_INPUT)
+    assert ans.exit_code == 0
+    assert ans.output == ('<doc n="9" t="a">\ny\n</doc>\n<doc n="10" t="b">\n'
+                          'x\n</doc>\n<doc n="10" t="a">\nx\n</doc>\n'
+                          '<doc t="c">\nz\n</doc>\n')
+
+
+def test_sort_passes():
+    # with no memory, each structure is a run of its own, so there are more
+    # runs than can be merged at once
+    docs = ['<doc n="{}" i="{}">\nx\n</doc>\n'.format(i % 7, i)
+            for i in range(200)]
+    ans = R.invoke(vrt, opt("sort -k n:int -m 0"), input="".join(docs))
+    assert ans.exit_code == 0
+    assert ans.output == "".join(sorted(docs, key=lambda d: int(d[8])))
+
+
+def test_dedup(fix=Fix()):
+    ans = R.invoke(vrt, opt("dedup -s chunk"), input=fix.test3)
+    assert ans.exit_code == 0
+    assert ans.output == ('<chunk author="foo">\nfoo\nbar\nbaz\n</chunk>\n'
+                          '<chunk author="bar">\nbar\nbaz\nqux\n</chunk>\n')
+
+    ans = R.invoke(vrt, opt("dedup"), input=SORT_INPUT)
+    assert ans.exit_code == 0
+    assert ans.output == SORT_INPUT
+
+    ans = R.invoke(vrt, opt("dedup -c"), input=SORT_INPUT)
+    assert ans.exit_code == 0
+    assert ans.output == ('<doc n="10" t="b">\nx\n</doc>\n<doc n="9" t="a">\n'
+                          'y\n</doc>\n<doc t="c">\nz\n</doc>\n')
+
+
+NEARDUP_INPUT = ('<doc id="1">\na\nb\nc\nd\ne\nf\ng\nh\n</doc>\n'
+                 '<doc id="2">\na\nb\nc\nd\ne\nf\ng\nx\n</doc>\n'
+                 '<doc id="3">\nq\nr\ns\nt\nu\nv\nw\ny\n</doc>\n')
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_neardup(jobs):
+    args = "neardup -n 1 -b 32 -r 2 -x 12 -j " + jobs
+    ans = R.invoke(vrt, opt(args), input=NEARDUP_INPUT)
+    assert ans.exit_code == 0
+    assert ans.output == ('<doc id="1">\na\nb\nc\nd\ne\nf\ng\nh\n</doc>\n'
+                          '<doc id="3">\nq\nr\ns\nt\nu\nv\nw\ny\n</doc>\n')
+
+    ans = R.invoke(vrt, opt(args + " -m annotate"), input=NEARDUP_INPUT)
+    assert ans.exit_code == 0
+    starts = [l for l in ans.output.splitlines() if l.startswith("<doc")]
+    assert starts == ['<doc id="1" dup_cluster="0">',
+                      '<doc id="2" dup_cluster="0">',
+                      '<doc id="3" dup_cluster="2">']
+
+
+def test_sample():
+    from pyvert.vrt import sample, linewise
+
+    ans = R.invoke(vrt, opt("sample -k 2 --seed 3"), input=SORT_INPUT)
+    assert ans.exit_code == 0
+    docs = ans.output.split("</doc>\n")[:-1]
+    assert len(docs) == 2
+    # structures are output in their original order
+    assert all(doc + "</doc>\n" in SORT_INPUT for doc in docs)
+    assert SORT_INPUT.index(docs[0]) < SORT_INPUT.index(docs[1])
+    # the in-memory variant chooses the same structures
+    assert "".join(sample(linewise(SORT_INPUT), "doc", 2, seed=3)) == \
+        ans.output
+
+    ans = R.invoke(vrt, opt("sample -k 1 -b t"), input=SORT_INPUT)
+    assert ans.exit_code == 0
+    starts = [l for l in ans.output.splitlines() if l.startswith("<doc")]
+    assert [l[-3] for l in starts] == ["b", "a", "c"] or \
+        [l[-3] for l in starts] == ["b", "c", "a"]
+
+
+def test_split(tmpdir):
+    template = str(tmpdir.join("rr-{}.vrt"))
+    ans = R.invoke(vrt, opt("split -n 3 --max-open 1 --buffer 1 -o " +
+                            template), input=SORT_INPUT)
+    assert ans.exit_code == 0
+    assert ans.output == ""
+    docs = SORT_INPUT.split("</doc>\n")
+    assert tmpdir.join("rr-0.vrt").read() == \
+        docs[0] + "</doc>\n" + docs[3] + "</doc>\n"
+    assert tmpdir.join("rr-2.vrt").read() == docs[2] + "</doc>\n"
+
+    template = str(tmpdir.join("t-{}.vrt.gz"))
+    ans = R.invoke(vrt, opt("split -m value -a t --max-open 1 --buffer 1 "
+                            "-o " + template), input=SORT_INPUT)
+    assert ans.exit_code == 0
+    with gzip.open(str(tmpdir.join("t-a.vrt.gz")), "rt") as fh:
+        assert fh.read() == docs[1] + "</doc>\n" + docs[3] + "</doc>\n"
+
+    ans = R.invoke(vrt, opt("split -m hash -a n -n 4 -o " + template),
+                   input=SORT_INPUT)
+    assert ans.exit_code != 0
+
+
 @pytest.mark.parametrize("fix", [Fix(), Fix(True)])
 def test_group(fix):
     ans = R.invoke(vrt, opt("group -t chunk -a author"),
@@ -78,6 +284,34 @@ def test_group(fix):
     assert ans.output == fix.test2_group2
 
 
+def test_group_sorted(fix=Fix()):
+    ans = R.invoke(vrt, opt("group -t chunk -a author --sorted"),
+                   input=fix.test1)
+    assert ans.exit_code != 0
+    assert "not sorted" in str(ans.exception)
+
+    text = R.invoke(vrt, opt("sort -s chunk -k author"),
+                    input=fix.test1).output
+    expected = R.invoke(vrt, opt("group -t chunk -a author"), input=text)
+    ans = R.invoke(vrt, opt("group -t chunk -a author --sorted"), input=text)
+    assert ans.exit_code == 0
+    assert ans.output == expected.output
+    ans = R.invoke(vrt, opt("group -t chunk -a author --sorted -r"),
+                   input=text)
+    assert ans.exit_code != 0
+
+    text = ('<doc id="d" a="1">\n<s n="9">\nx\n</s>\ny\n<p>\n<s n="10">\nz\n'
+            '</s>\n</p>\n<s n="10" id="q">\nw\n</s>\n</doc>\n') * 2
+    for args in ("-p doc", "-p doc -u"):
+        expected = R.invoke(vrt, opt("group -t s -a n " + args), input=text)
+        ans = R.invoke(vrt, opt("group -t s -a n:int --sorted " + args),
+                       input=text)
+        assert ans.exit_code == 0
+        assert ans.output == expected.output
+    ans = R.invoke(vrt, opt("group -t s -a n --sorted -p doc"), input=text)
+    assert ans.exit_code != 0
+
+
 def test_unescape():
     ans = R.invoke(vrt, opt("unescape"), input="&amp;\n&lt;\n")
     assert ans.exit_code == 0
@@ -107,5 +341,486 @@ def test_file_input_and_wrap(fix):
     assert ans.output == fix.test3_wrap1
 
 
+def test_checkpoint(tmpdir):
+    good = ('<doc a="1">\nx\n</doc>\n<doc a="1">\ny\n</doc>\n'
+            '<doc a="2">\nz\n</doc>\n<doc a="3">\nw\n</doc>\n')
+    bad = good.replace('<doc a="2">', "<doc>")
+    vert, out = tmpdir.join("in.vrt"), tmpdir.join("out.vrt")
+    ckpt = tmpdir.join("ckpt.json")
+    args = ["-l", "WARNING", "-i", str(vert), "-o", str(out), "--checkpoint",
+            str(ckpt), "--checkpoint-every", "1", "wrap", "-a", "a"]
+
+    vert.write(good)
+    ans = R.invoke(vrt, args)
+    assert ans.exit_code == 0
+    assert not ckpt.check()
+    expected = out.read()
+
+    # the run fails on the third structure, but the first two are recorded
+    vert.write(bad)
+    ans = R.invoke(vrt, args)
+    assert ans.exit_code != 0
+    assert json.loads(ckpt.read())["ordinal"] == 1
+
+    # resume after fixing the input
+    vert.write(good)
+    out.write("garbage past the checkpoint", mode="a")
+    ans = R.invoke(vrt, args)
+    assert ans.exit_code == 0
+    assert out.read() == expected
+    assert not ckpt.check()
+
+    # a checkpoint can't be reused with different parameters
+    vert.write(bad)
+    R.invoke(vrt, args)
+    ans = R.invoke(vrt, args[:-1] + ["b"])
+    assert ans.exit_code != 0
+    # nor with different encodings
+    ans = R.invoke(vrt, ["--outenc", "latin-1"] + args)
+    assert ans.exit_code != 0
+    assert "different" in str(ans.exception)
+    ckpt.remove()
+
+    # commands which don't record their progress can't be checkpointed
+    ans = R.invoke(vrt, args[:-3] + ["sort", "-k", "a"])
+    assert ans.exit_code != 0
+    assert "isn't supported by sort" in str(ans.exception)
+    assert not ckpt.check()
+
+    # chunk resumes with the state of its random number generator
+    docs = ['<doc id="{}">\n{}</doc>\n'.format(
+        i, "<s>\nx\n</s>\n" * 20) for i in range(4)]
+    good = "".join(docs)
+    bad = good.replace('<doc id="2">\n<s>', '<doc id="2">\n<s>\n<s>', 1)
+    args = args[:-3] + ["chunk", "-a", "doc", "-c", "s", "-m", "1", "10"]
+    vert.write(good)
+    ans = R.invoke(vrt, args)
+    assert ans.exit_code == 0
+    expected = out.read()
+    # the default chunking doesn't depend on the threads and the cache
+    ans = R.invoke(vrt, opt("--threads 2 chunk -a doc -c s -m 1 10"),
+                   input=good)
+    assert ans.output == expected
+    cached = R.invoke(vrt, opt("--cache {} chunk -a doc -c s -m 1 10".format(
+        tmpdir.join("cache"))), input=good)
+    assert cached.exit_code == 0
+    assert cached.output != expected
+    vert.write(bad)
+    ans = R.invoke(vrt, args)
+    assert ans.exit_code != 0
+    assert json.loads(ckpt.read())["ordinal"] == 1
+    vert.write(good)
+    ans = R.invoke(vrt, args)
+    assert ans.exit_code == 0
+    assert out.read() == expected
+
+
+def test_cache(tmpdir, fix=Fix()):
+    args = ["--cache", str(tmpdir.join("cache")), "project", "-p", "doc",
+            "-c", "s"]
+    expected = R.invoke(vrt, opt("project -p doc -c s"), input=fix.test4)
+    # the second run is served from the cache, the third one partially
+    for old, new in (("", ""), ("", ""), ("sat", "zzz")):
+        ans = R.invoke(vrt, opt("") + args, input=fix.test4.replace(old, new))
+        assert ans.exit_code == 0
+        assert ans.output == expected.output.replace(old, new)
+
+    cache = StructCache(str(tmpdir.join("lru")), "prefix", size=10)
+    keys = [cache.key(raw) for raw in ("a", "b", "c")]
+    cache.put(keys[0], "123456")
+    assert cache.get(keys[0]) == "123456"
+    assert cache.get(keys[1]) is None
+    cache.put(keys[1], "123456")
+    assert cache.get(keys[0]) is None
+    assert cache.get(keys[1]) == "123456"
+    assert (cache.hits, cache.misses) == (2, 2)
+    cache.close()
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_batch(tmpdir, jobs, fix=Fix()):
+    indir, outdir = tmpdir.mkdir("in"), tmpdir.join("out")
+    indir.join("a.vrt").write(fix.test1)
+    indir.mkdir("sub").join("b.vrt").write(fix.test2)
+    indir.join("c.txt").write("not a vertical")
+    args = ["-l", "WARNING", "-I", str(indir), "-O", str(outdir),
+            "--batch-jobs", jobs,
+            "filter", "-s", "chunk", "-a", "author", "foo"]
+    ans = R.invoke(vrt, args)
+    assert ans.exit_code == 0
+    assert outdir.join("a.vrt").read() == fix.test1_filter1
+    assert outdir.join("sub", "b.vrt").read() == fix.test2_filter1
+    assert not outdir.join("c.txt").check()
+    assert sorted(json.loads(outdir.join(".vrt-manifest.json").read())) == \
+        ["a.vrt", os.path.join("sub", "b.vrt")]
+
+    # up-to-date outputs are skipped...
+    outdir.join("a.vrt").write("untouched")
+    outdir.join("a.vrt").setmtime(indir.join("a.vrt").mtime() + 10)
+    ans = R.invoke(vrt, args)
+    assert ans.exit_code == 0
+    assert outdir.join("a.vrt").read() == "untouched"
+
+    # ... unless the parameters change
+    ans = R.invoke(vrt, args[:-1] + ["bar"])
+    assert ans.exit_code == 0
+    assert outdir.join("a.vrt").read() != "untouched"
+
+    # file parameters are passed on to the workers
+    patterns = tmpdir.join("patterns.txt")
+    patterns.write("foo\n")
+    ans = R.invoke(vrt, args[:-6] + ["grep", "-s", "chunk", "-f",
+                                     str(patterns)])
+    assert ans.exit_code == 0
+    assert outdir.join("sub", "b.vrt").read() == fix.test2_filter1
+
+    ans = R.invoke(vrt, args[:-6] + ["--cache", str(tmpdir.join("cache")),
+                                     "strip"])
+    assert (ans.exit_code == 0) == (jobs == "1")
+
+
+def test_follow(tmpdir):
+    from pyvert._follow import FollowReader
+    vert = tmpdir.join("in.vrt")
+    vert.write('<doc a="1">\nx\n</doc>\n<doc a="2">\ny\n</do')
+    steps = [lambda: vert.write("c>\n", mode="a"),
+             # rotate the file
+             lambda: vert.rename(tmpdir.join("in.vrt.1")),
+             lambda: vert.write('<doc a="1">\nz\n</doc>\n<end/>\n')]
+
+    def idle():
+        # each step is only taken once everything before it has been read
+        if steps:
+            steps.pop(0)()
+
+    with open(str(vert), "rb") as buffer:
+        reader = FollowReader(str(vert), buffer, interval=0.01, timeout=30,
+                              idle=idle)
+        lines = []
+        for line in reader:
+            if line == "<end/>\n":
+                break
+            lines.append(line)
+    assert "".join(lines) == ('<doc a="1">\nx\n</doc>\n<doc a="2">\ny\n'
+                              '</doc>\n<doc a="1">\nz\n</doc>\n')
+
+    # nothing is written while following from the command line, so the
+    # timeout can be short
+    vert.write('<doc a="1">\nx\n</doc>\n<doc a="3">\ny\n</doc>\n')
+    args = "-f --follow-interval 0.01 --follow-timeout 0.05 "
+    ans = R.invoke(vrt, optf(str(vert), args + "filter -a a 1"))
+    assert ans.exit_code == 0
+    assert ans.output == '<doc a="1">\nx\n</doc>\n'
+    # the whole vertical is read at once when it's not split into known
+    # structures, which follows too
+    from pyvert import iterstruct
+    steps = [lambda: vert.write("<doc/>\n", mode="a")]
+    with open(str(vert), "rb") as buffer:
+        reader = FollowReader(str(vert), buffer, interval=0.01, timeout=0.05,
+                              idle=idle)
+        root, = iterstruct(reader, None, structs={"doc"})
+        assert len(root.xml) == 3
+
+
+@pytest.mark.parametrize("fix", [Fix(), Fix(True)])
+def test_compile(tmpdir, fix):
+    corpus = str(tmpdir.join("test1.pvc"))
+    ans = R.invoke(vrt, opt("compile " + corpus), input=fix.test1)
+    assert ans.exit_code == 0
+    assert ans.output == ""
+
+    ans = R.invoke(vrt, optf(corpus, "decompile"))
+    assert ans.exit_code == 0
+    assert ans.output == fix.test1.rstrip() + "\n"
+
+    for args in ("filter -s chunk -a author foo", "strip", "stats -c 0",
+                 "group -t chunk -a author -p doc", "sample -s chunk -k 1"):
+        expected = R.invoke(vrt, opt(args), input=fix.test1)
+        ans = R.invoke(vrt, optf(corpus, args))
+        assert ans.exit_code == 0
+        # compiled corpora always end with a newline
+        assert ans.output.rstrip() == expected.output.rstrip()
+
+    corpus = str(tmpdir.join("test4.pvc"))
+    ans = R.invoke(vrt, opt("compile " + corpus), input=fix.test4)
+    assert ans.exit_code == 0
+    expected = R.invoke(vrt, opt("stats -c 1 -c 2"), input=fix.test4)
+    ans = R.invoke(vrt, optf(corpus, "stats -c 1 -c 2"))
+    assert json.loads(ans.output) == json.loads(expected.output)
+
+    # the error of a failing command isn't masked by closing the corpus
+    ans = R.invoke(vrt, optf(corpus, "wrap -t doc -a missing"))
+    assert ans.exit_code != 0
+    assert isinstance(ans.exception, RuntimeError)
+    assert "attribute" in str(ans.exception)
+    from pyvert import Corpus
+    c = Corpus(corpus)
+    records = list(c.records("s"))
+    lexicon = c.lexicons[0]
+    c.close()
+    assert len(records) == 3
+    with pytest.raises(ValueError):
+        lexicon[0]
+
+
+@pytest.mark.parametrize("fix", [Fix(), Fix(True)])
+def test_incremental(fix):
+    for args, text in (("group -t chunk -a author", fix.test1),
+                       ("group -t chunk -a author -p doc", fix.test2),
+                       ("chunk -a doc -c s -m 1 2", fix.test4),
+                       ("project -p doc -c s", fix.test4),
+                       ("identify -s s", fix.test4)):
+        expected = R.invoke(vrt, opt(args), input=text)
+        ans = R.invoke(vrt, opt("--incremental " + args), input=text)
+        assert ans.exit_code == 0
+        assert ans.output == expected.output
+
+    from pyvert import iterstruct
+    from io import StringIO
+    docs = list(iterstruct(StringIO(fix.test4), "doc", incremental=True))
+    assert [d.attr["id"] for d in docs] == ["d1", "d2"]
+    assert [len(d.xml) for d in docs] == [2, 1]
+    # the first structure is read whole to discover the valid tags
+    assert docs[0].raw.startswith('<doc id="d1"')
+    with pytest.raises(RuntimeError):
+        docs[1].raw
+    docs = iterstruct(StringIO(fix.test4), "doc", structs={"doc", "s"},
+                      incremental=True, keep_raw=True)
+    assert "".join(d.raw for d in docs) == fix.test4.rstrip() + "\n"
+
+    # known structs and no parent: the whole vertical is wrapped in <root>
+    for incremental in (False, True):
+        root, = iterstruct(StringIO(fix.test4), None, structs={"doc", "s"},
+                           incremental=incremental)
+        assert root.xml.tag == "root"
+        assert [d.get("id") for d in root.xml] == ["d1", "d2"]
+    expected = R.invoke(vrt, opt("group -t doc -a genre"), input=fix.test4)
+    env = dict(PYVERT_STRUCTS="doc s")
+    ans = subprocess.run(
+        [sys.executable, "-c", "from pyvert.vrt import vrt; vrt()",
+         "-l", "WARNING", "--incremental", "group", "-t", "doc", "-a",
+         "genre"], input=fix.test4, env=dict(os.environ, **env),
+        stdout=subprocess.PIPE, universal_newlines=True)
+    assert ans.returncode == 0
+    assert ans.stdout == expected.output
+
+    with pytest.raises(Exception, match="dumped to"):
+        list(iterstruct(StringIO("<doc>\n<s>\na\n</doc>\n"), "doc",
+                        structs={"doc", "s"}, incremental=True))
+
+
+@pytest.mark.parametrize("fix", [Fix(), Fix(True)])
+def test_threads(fix):
+    for args, text in (("group -t chunk -a author", fix.test1),
+                       ("group -t chunk -a author -p doc", fix.test2),
+                       ("chunk -a doc -c s -m 1 2", fix.test4),
+                       ("project -p doc -c s", fix.test4),
+                       ("identify -s s", fix.test4)):
+        expected = R.invoke(vrt, opt(args), input=text)
+        for threads in ("--threads 2 ", "--threads 3 --incremental "):
+            ans = R.invoke(vrt, opt(threads + args), input=text)
+            assert ans.exit_code == 0
+            assert ans.output == expected.output
+
+    from pyvert.vrt import _threaded
+    started = []
+
+    def work(i):
+        started.append(i)
+        # later items finish first
+        time.sleep(0.01 * (i % 3))
+        return i, threading.get_ident()
+
+    results = list(_threaded(work, range(20), 4))
+    assert [i for i, _ in results] == list(range(20))
+    assert len({ident for _, ident in results}) > 1
+    # the input isn't read further ahead than the window
+    started = []
+    gen = _threaded(work, range(100), 2, window=3)
+    next(gen)
+    gen.close()
+    assert len(started) <= 4
+
+
+def test_context(tmpdir, fix=Fix()):
+    from pyvert import iterstruct, Corpus
+    from io import StringIO
+
+    def contexts(vert_file, struct, **kwargs):
+        return [(s.attr.get("n"), [(c.name, c.attr.get("id"))
+                                   for c in s.context])
+                for s in iterstruct(vert_file, struct, **kwargs)]
+
+    text = ('<doc id="a">\n<p id="p1">\n<s n="1">\nx\n</s>\n</p>\n<s n="2">\n'
+            'y\n</s>\n</doc>\n<s n="3">\nz\n</s>\n<doc id="b">\n<p/>\n'
+            '<s n="4">\nw\n</s>\n</doc>\n')
+    expected = [("1", [("doc", "a"), ("p", "p1")]), ("2", [("doc", "a")]),
+                ("3", []), ("4", [("doc", "b")])]
+    assert contexts(StringIO(text), ("doc", "p", "s")) == expected
+    assert contexts(StringIO(text), ("doc", "p", "s"), structs={"doc", "p", "s"},
+                    incremental=True) == expected
+
+    corpus = str(tmpdir.join("context.pvc"))
+    R.invoke(vrt, opt("compile " + corpus), input=text)
+    with Corpus(corpus) as c:
+        assert contexts(c, ("doc", "p", "s")) == expected
+        assert contexts(c, "s") == [(n, []) for n, _ in expected]
+
+    docs = [[c.attr["genre"] for c in s.context]
+            for s in iterstruct(StringIO(fix.test4), ("doc", "s"))]
+    assert docs == [["news"], ["news"], ["fiction"]]
+
+
+@pytest.mark.parametrize("fix", [Fix(), Fix(True)])
+def test_validate(tmpdir, fix):
+    ans = R.invoke(vrt, opt("validate"), input=fix.test4)
+    assert ans.exit_code == 0
+    assert ans.output == ""
+
+    bad = tmpdir.join("bad.vrt")
+    bad.write_binary(b'<doc id="a">\n<s>\na\tb\nc\n</s>\n<p id="x" id="y">\n'
+                     b'<s>\nd\te\xff\n</doc>\n</p>\n<s bad>\n</s>\n')
+    expected = ("21\t4\texpected 2 columns, found 1\n"
+                "28\t6\t<p> not closed before </doc>\n"
+                "28\t6\tduplicate attributes in <p>\n"
+                "46\t7\t<s> not closed before </doc>\n"
+                "53\t8\tinvalid utf-8 byte sequence\n"
+                "62\t10\tstray </p>\n"
+                "67\t11\tmalformed attributes in <s>\n")
+    for args in ("validate", "validate -c 2", "validate -j 3",
+                 "validate -s doc -s s -s p"):
+        ans = R.invoke(vrt, optf(str(bad), args))
+        assert ans.exit_code != 0
+        assert ans.output == expected
+    ans = R.invoke(vrt, opt("validate"), input=bad.read_binary())
+    assert ans.output == expected
+    # the problems are reported with inputs read for --follow too
+    ans = R.invoke(vrt, optf(str(bad), "-f --follow-timeout 0.1 validate"))
+    assert ans.output == expected
+    assert isinstance(ans.exception, RuntimeError)
+    assert "bad.vrt" in str(ans.exception)
+
+
+def test_aio(fix=Fix()):
+    import asyncio
+    from io import StringIO
+    from pyvert import aio, iterstruct
+
+    def reader(text):
+        stream = asyncio.StreamReader()
+        stream.feed_data(text.encode("utf-8"))
+        stream.feed_eof()
+        return stream
+
+    async def run():
+        structs = [s async for s in aio.iterstruct(reader(fix.test4), "s",
+                                                   parse=True)]
+        assert [s.raw for s in structs] == \
+            [s.raw for s in iterstruct(StringIO(fix.test4), "s")]
+        assert [len(s.xml.text.split()) for s in structs] == [9, 9, 6]
+
+        # several streams at once
+        args = dict(struct="chunk", attr=[("author", "foo")])
+        outputs = await asyncio.gather(*(
+            _collect(aio.command("filter", reader(fix.test1), **args))
+            for _ in range(4)))
+        assert outputs == [fix.test1_filter1] * 4
+
+        with pytest.raises(RuntimeError):
+            await _collect(aio.command("wrap", reader(fix.test1),
+                                       target="chunk", attr=["missing"]))
+
+        # closing early doesn't leave the worker hanging
+        output = aio.command("strip", reader(fix.test4 * 1000), queue=1)
+        async for chunk in output:
+            break
+        await output.aclose()
+
+    asyncio.run(asyncio.wait_for(run(), 10))
+
+
+async def _collect(chunks):
+    return "".join([chunk async for chunk in chunks])
+
+
+def test_columns(tmpdir, fix=Fix()):
+    np = pytest.importorskip("numpy")
+    from pyvert import iterstruct, itercolumns, Vocabulary, Corpus
+    from io import StringIO
+
+    batches = list(itercolumns(StringIO(fix.test4), "s", columns=(1, 2),
+                               batch=2))
+    assert [len(b) for b in batches] == [2, 1]
+    assert list(batches[0].lengths()) == [3, 3]
+    assert list(batches[1].offsets) == [0, 2]
+    lemmas, tags = batches[0].vocabularies
+    # vocabularies are shared across batches
+    assert batches[1].vocabularies[0] is lemmas
+    assert lemmas.decode(batches[1].codes[0]) == ["cat", "sleep"]
+    counts = sum(np.bincount(b.codes[0], minlength=len(lemmas))
+                 for b in batches)
+    assert counts[lemmas.code("cat")] == 2
+    assert batches[0].counts(1)[tags.code("DT")] == 2
+
+    vocab = Vocabulary()
+    docs = [s.columns(vocabularies=[vocab])
+            for s in iterstruct(StringIO(fix.test4), "doc")]
+    assert [d.attrs[0]["id"] for d in docs] == ["d1", "d2"]
+    assert vocab.decode(docs[1].codes[0]) == ["Cats", "sleep"]
+    assert len(vocab) == 8
+
+    # compiled corpora yield the same columns
+    corpus = str(tmpdir.join("test4.pvc"))
+    R.invoke(vrt, opt("compile " + corpus), input=fix.test4)
+    with Corpus(corpus) as c:
+        compiled = list(itercolumns(c, "s", columns=(1, 2), batch=2))
+    assert [list(b.codes[0]) for b in compiled] == \
+        [list(b.codes[0]) for b in batches]
+
+
+@pytest.mark.parametrize("memory", ["512", "0"])
+def test_annotate(tmpdir, memory, fix=Fix()):
+    table = tmpdir.join("meta.tsv")
+    table.write("id\tgenre\tauthor\nd2\tpoetry\tDoe & <Co>\nd3\tnews\tX\n")
+    args = "annotate -t {} -m {} -s doc ".format(table, memory)
+    # like in project, attributes the structure already has are skipped
+    expected = fix.test4.replace(
+        '<doc id="d2" genre="fiction">',
+        '<doc id="d2" genre="fiction" author="Doe &amp; &lt;Co&gt;">')
+    ans = R.invoke(vrt, opt(args), input=fix.test4)
+    assert ans.exit_code == 0
+    assert ans.output == expected
+
+    ans = R.invoke(vrt, opt(args + "-w -p doc_"), input=fix.test4)
+    assert ans.exit_code == 0
+    assert ans.output == fix.test4.replace(
+        '<doc id="d2" genre="fiction">',
+        '<doc id="d2" genre="fiction" doc_genre="poetry" '
+        'doc_author="Doe &amp; &lt;Co&gt;">')
+    ans = R.invoke(vrt, opt(args + "-w"), input=fix.test4)
+    assert ans.exit_code == 0
+    assert '<doc id="d2" genre="poetry" author=' in ans.output
+    from pyvert import iterstruct
+    from io import StringIO
+    doc = list(iterstruct(StringIO(ans.output), "doc"))[1]
+    assert doc.xml.get("author") == "Doe & <Co>"
+
+    table.write("id\tgenre\nd1\tnews\textra\n")
+    ans = R.invoke(vrt, opt(args), input=fix.test4)
+    assert ans.exit_code != 0
+
+
+@pytest.mark.parametrize("command", ["strip", "unescape"])
+def test_lazy_imports(command):
+    # a fresh interpreter is needed, lxml is already imported in this one
+    script = ("import sys; from pyvert.vrt import vrt; "
+              "vrt(['{}'], standalone_mode=False); "
+              "assert 'lxml' not in sys.modules; "
+              "assert 'pkg_resources' not in sys.modules".format(command))
+    proc = subprocess.run([sys.executable, "-c", script], input=b"a\tb\n",
+                          stdout=subprocess.PIPE)
+    assert proc.returncode == 0
+
+
 def test_all_resources_were_accessed(fix=Fix()):
     assert set(fix._fix.keys()) == ACCESSED